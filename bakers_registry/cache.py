@@ -0,0 +1,112 @@
+import os
+import pickle
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+FINALITY_DEPTH = 60  # levels below head that are not going to be reorganized
+RECENT_TTL = 120  # seconds to keep diffs of non-final levels
+
+
+def default_cache_dir():
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'bakers-registry')
+
+
+class DiffCache:
+    """
+    Persistent store of parsed big map diffs, keyed by (network, registry address, level).
+    Also keeps the level up to which the stored history is complete, materialized registry states
+    and the field indexes of the last queried state.
+    """
+
+    def __init__(self, cache_dir=None):
+        cache_dir = cache_dir or default_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'diffs.sqlite3')
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS diffs ('
+                          'network TEXT, registry TEXT, level INTEGER, '
+                          'diff BLOB, final INTEGER, updated_at REAL, '
+                          'PRIMARY KEY (network, registry, level))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS checkpoints ('
+                          'network TEXT, registry TEXT, level INTEGER, state BLOB, '
+                          'PRIMARY KEY (network, registry, level))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS synced ('
+                          'network TEXT, registry TEXT, level INTEGER, '
+                          'PRIMARY KEY (network, registry))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS indexes ('
+                          'network TEXT, registry TEXT, level INTEGER, index_data BLOB, '
+                          'PRIMARY KEY (network, registry))')
+        self.conn.commit()
+
+    def get_many(self, network, registry_address, levels: Iterable[int]) -> Dict[int, dict]:
+        """Return cached diffs for the requested levels, skipping expired non-final ones"""
+        levels = set(levels)
+        if not levels:
+            return {}
+        expire_before = time.time() - RECENT_TTL
+        rows = self.conn.execute('SELECT level, diff, final, updated_at FROM diffs '
+                                 'WHERE network = ? AND registry = ? AND level BETWEEN ? AND ?',
+                                 (network, registry_address, min(levels), max(levels)))
+        return {
+            level: pickle.loads(diff)
+            for level, diff, final, updated_at in rows
+            if level in levels and (final or updated_at > expire_before)
+        }
+
+    def put_many(self, network, registry_address, updates: List[Tuple[int, dict]], head_level: int):
+        """Store diffs, levels deeper than FINALITY_DEPTH below head are marked as final"""
+        now = time.time()
+        self.conn.executemany('INSERT OR REPLACE INTO diffs VALUES (?, ?, ?, ?, ?, ?)', [
+            (network, registry_address, level,
+             pickle.dumps(diff, protocol=pickle.HIGHEST_PROTOCOL),
+             int(head_level - level >= FINALITY_DEPTH), now)
+            for level, diff in updates
+        ])
+        self.conn.commit()
+
+    def get_range(self, network, registry_address, start: int, end: int) -> List[Tuple[int, dict]]:
+        """Return stored diffs for start < level <= end, ordered by level"""
+        rows = self.conn.execute('SELECT level, diff FROM diffs '
+                                 'WHERE network = ? AND registry = ? AND level > ? AND level <= ? '
+                                 'ORDER BY level',
+                                 (network, registry_address, start, end))
+        return [(level, pickle.loads(diff)) for level, diff in rows]
+
+    def get_synced_level(self, network, registry_address) -> int:
+        row = self.conn.execute('SELECT level FROM synced WHERE network = ? AND registry = ?',
+                                (network, registry_address)).fetchone()
+        return row[0] if row else 0
+
+    def set_synced_level(self, network, registry_address, level: int):
+        """Mark history as complete up to the level, stored diffs below it become final"""
+        self.conn.execute('UPDATE diffs SET final = 1 WHERE network = ? AND registry = ? AND level <= ?',
+                          (network, registry_address, level))
+        self.conn.execute('INSERT OR REPLACE INTO synced VALUES (?, ?, ?)', (network, registry_address, level))
+        self.conn.commit()
+
+    def get_checkpoint(self, network, registry_address, level: int) -> Optional[Tuple[int, object]]:
+        """Return the nearest checkpoint at or below the level"""
+        row = self.conn.execute('SELECT level, state FROM checkpoints '
+                                'WHERE network = ? AND registry = ? AND level <= ? '
+                                'ORDER BY level DESC LIMIT 1',
+                                (network, registry_address, level)).fetchone()
+        return (row[0], pickle.loads(row[1])) if row else None
+
+    def put_checkpoint(self, network, registry_address, level: int, state):
+        self.conn.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)',
+                          (network, registry_address, level, pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)))
+        self.conn.commit()
+
+    def get_index(self, network, registry_address, level: int) -> Optional[object]:
+        """Return the stored index if it was built at exactly this level"""
+        row = self.conn.execute('SELECT index_data FROM indexes WHERE network = ? AND registry = ? AND level = ?',
+                                (network, registry_address, level)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def put_index(self, network, registry_address, level: int, index):
+        """Store the index, replacing the one built at another level"""
+        self.conn.execute('INSERT OR REPLACE INTO indexes VALUES (?, ?, ?, ?)',
+                          (network, registry_address, level, pickle.dumps(index, protocol=pickle.HIGHEST_PROTOCOL)))
+        self.conn.commit()
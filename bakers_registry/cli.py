@@ -1,12 +1,16 @@
+import atexit
+import os
 import sys
 import fire
 import simplejson as json
 from pprint import pformat
-from pytezos.rpc.errors import RpcError
 
+# network, cache and diff modules are imported by the commands that use them, keeping startup fast
 from bakers_registry.encoding import decode_info, encode_info
 from bakers_registry.colored import PrinterJSON, PrinterLog
-from bakers_registry.core import get_all_bakers, upsert_baker, get_unify_diff, get_baker
+from bakers_registry.rpc import DEFAULT_CONCURRENCY
+
+FOLLOW_BAKER_LENGTH = 20
 
 
 def fail(data):
@@ -15,8 +19,49 @@ def fail(data):
 
 
 def info(data):
-    PrinterJSON().print_data(data)
-    sys.stdout.write('\n')
+    printer = PrinterJSON()
+    printer.print_data(data)
+    printer.write('\n')
+    printer.flush()
+
+
+def check_network(network):
+    """Indexers only know mainnet, custom RPC nodes are accepted on the assumption they serve it"""
+    if network != 'mainnet' and not all(url.startswith(('http://', 'https://')) for url in network.split(',')):
+        fail('Only mainnet is supported at the moment, or comma-separated urls of its RPC nodes')
+
+
+def disable_spinners():
+    """Keep progress spinners out of stdout when the data is written there"""
+    from bakers_registry.metrics import set_spinners
+    set_spinners(False)
+
+
+def write_ndjson(items, output_file=None):
+    """Write items one per line as soon as they are produced, '-' or None stands for stdout"""
+    f = open(output_file, 'w+') if output_file and output_file != '-' else sys.stdout
+    try:
+        for item in items:
+            f.write(json.dumps(item))
+            f.write('\n')
+            f.flush()
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+def read_addresses(input_file) -> list:
+    """Read whitespace-separated addresses from the file, "-" stands for stdin"""
+    if input_file == '-':
+        return sys.stdin.read().split()
+    with open(input_file) as f:
+        return f.read().split()
+
+
+def write_metrics(metrics_file):
+    from bakers_registry.metrics import get_metrics
+    with open(metrics_file, 'w+') as f:
+        f.write(json.dumps(get_metrics().to_dict(), indent=4))
 
 
 class BakersRegistryCli:
@@ -29,54 +74,124 @@ class BakersRegistryCli:
     * Registry FAQ: https://hackmd.io/DZyJU5HSThmGX8ER7tprXg
     """
 
-    def get(self, baker_address, output_file=None, raw=False,
+    def __init__(self, record=None, replay=None, latency_scale=1.0, profile=False, metrics_file=None):
+        """
+        :param record: path to the cassette to record all indexer and node responses to (optional)
+        :param replay: path to the cassette to serve responses from, network is not used (optional)
+        :param latency_scale: multiplier for recorded latencies when replaying (default is 1.0)
+        :param profile: print time spent in every stage and request statistics to stderr (default is False)
+        :param metrics_file: path to the file to store the same metrics as JSON (optional)
+        """
+        if profile:
+            from bakers_registry.metrics import get_metrics
+            atexit.register(get_metrics().print_summary)
+        if metrics_file:
+            atexit.register(write_metrics, metrics_file)
+        assert not (record and replay), 'Cannot record and replay at the same time'
+        if record or replay:
+            from bakers_registry.transport import use_transport, RECORD, REPLAY
+        if record:
+            atexit.register(use_transport(RECORD, cassette=record).save)
+        elif replay:
+            use_transport(REPLAY, cassette=replay, latency_scale=latency_scale)
+
+    def get(self, *baker_addresses, input_file=None, output_file=None, raw=False, level=None, no_cache=False,
+            concurrency=DEFAULT_CONCURRENCY, indexer='tzkt',
             network='mainnet', registry_address='KT1ChNsEFxwyCbJyWGSL3KdjeXE28AY1Kaog'):
         """
-        Get the current baker config
-        :param baker_address: tz-address
+        Get the current baker config, or configs of several bakers as an address => config map
+        :param baker_addresses: one or more tz-addresses
+        :param input_file: path to the file with tz-addresses, one per line ("-" for stdin) (optional)
         :param output_file: path to the file to store the data (optional)
         :param raw: keep intermediate data representation (default is False)
+        :param level: get the config at the given level, taken from the local history if synced (default is head)
+        :param no_cache: do not use local history of big map diffs (default is False)
+        :param concurrency: max number of RPC requests in flight (default is 50)
+        :param indexer: which indexer to use for bulk lookups [tzkt] (default is tzkt)
         :param network: Tezos network (default is mainnet)
         :param registry_address: address of the registry contract (predefined)
         """
+        from pytezos.rpc.errors import RpcError
+        from bakers_registry.core import get_bakers
+        from bakers_registry.cache import DiffCache
+
+        addresses = list(baker_addresses)
+        if input_file:
+            addresses.extend(read_addresses(input_file))
+        addresses = list(dict.fromkeys(addresses))
+        if not addresses:
+            fail('No baker addresses')
+
         try:
-            data = get_baker(
+            data = get_bakers(
                 registry_address=registry_address,
-                baker_address=baker_address,
+                bakers_addresses=addresses,
                 raw=raw,
-                network=network)
+                network=network,
+                concurrency=concurrency,
+                level=level,
+                cache=None if no_cache else DiffCache(),
+                indexer=indexer)
         except RpcError as e:
             fail(next(iter(e.args)))
         else:
             if not data:
                 fail('Not found')
 
+            if len(addresses) == 1 and not input_file:
+                data = data[addresses[0]]
+            else:
+                for address in addresses:
+                    if address not in data:
+                        print(f'Not found: {address}', file=sys.stderr)
+                data = {address: data[address] for address in addresses if address in data}
+
             if output_file:
                 with open(output_file, 'w+') as f:
                     f.write(json.dumps(data, indent=4))
             else:
                 info(data)
 
-    def set(self, baker_address, input_file, preview=False,
+    def set(self, baker_address=None, input_file=None, input_dir=None, signer=None, preview=False,
+            concurrency=DEFAULT_CONCURRENCY, indexer='tzkt',
             network='mainnet', registry_address='KT1ChNsEFxwyCbJyWGSL3KdjeXE28AY1Kaog'):
         """
-        Generate tezos-client command from the config file
-        :param baker_address: tz-address
+        Generate tezos-client command from the config file, or one command per signer for many configs
+        :param baker_address: tz-address, if omitted the input file should map baker addresses to configs
         :param input_file: path to the file with configuration (can contain any-level representation)
+        :param input_dir: path to the directory with configurations named <baker_address>.json (optional)
+        :param signer: account to send all operations from (default is each baker itself)
         :param preview: print resulting diff and simulate operation instead of command line (default is False)
+        :param concurrency: max number of RPC requests in flight (default is 50)
+        :param indexer: which indexer to use for bulk lookups [tzkt] (default is tzkt)
         :param network: Tezos network (default is mainnet)
         :param registry_address: address of the registry contract (predefined)
         """
-        with open(input_file, 'r') as f:
-            data = json.loads(f.read(), use_decimal=True)
+        from pytezos.rpc.errors import RpcError
+        from bakers_registry.core import upsert_bakers
+
+        configs = dict()
+        if input_file:
+            with open(input_file, 'r') as f:
+                data = json.loads(f.read(), use_decimal=True)
+            configs.update({baker_address: data} if baker_address else data)
+        if input_dir:
+            for filename in sorted(os.listdir(input_dir)):
+                if filename.endswith('.json'):
+                    with open(os.path.join(input_dir, filename), 'r') as f:
+                        configs[filename[:-len('.json')]] = json.loads(f.read(), use_decimal=True)
+        if not configs:
+            fail('No configs, specify input_file and/or input_dir')
 
         try:
-            cmdline, log = upsert_baker(
+            cmdlines, log = upsert_bakers(
                 registry_address=registry_address,
-                baker_address=baker_address,
-                data=data,
+                configs=configs,
                 dry_run=preview,
-                network=network
+                network=network,
+                signer=signer,
+                concurrency=concurrency,
+                indexer=indexer
             )
         except RpcError as e:
             fail(next(iter(e.args)))
@@ -84,7 +199,7 @@ class BakersRegistryCli:
             if preview:
                 PrinterLog().print_log(log)
             else:
-                print(cmdline)
+                print('\n'.join(cmdlines))
 
     def new(self, output_file=None):
         """
@@ -98,49 +213,192 @@ class BakersRegistryCli:
         else:
             info(data)
 
-    def all(self, output_file, raw=False,
-            indexer='tzkt', network='mainnet', registry_address='KT1ChNsEFxwyCbJyWGSL3KdjeXE28AY1Kaog'):
+    def all(self, output_file, raw=False, format='json', level=None, no_cache=False, concurrency=DEFAULT_CONCURRENCY,
+            source='blocks', indexer='tzkt', network='mainnet',
+            registry_address='KT1ChNsEFxwyCbJyWGSL3KdjeXE28AY1Kaog'):
         """
         Get all bakers
-        :param output_file: path to the file
+        :param output_file: path to the file ("-" for stdout in ndjson format)
         :param raw: keep intermediate data representation (default is False)
+        :param format: output format [json, ndjson], ndjson writes one baker per line (default is json)
+        :param level: registry state at the given level, replayed from the local history if synced (default is head)
+        :param no_cache: do not use local cache of big map diffs (default is False)
+        :param concurrency: max number of RPC requests in flight (default is 50)
+        :param source: where big map diffs come from [blocks, indexer] (default is blocks)
         :param indexer: which indexer to use to retrieve operation levels [tzkt, tzstats, conseil]
-        :param network: Tezos network (default is mainnet)
+        :param network: mainnet or comma-separated urls of its RPC nodes (default is mainnet)
         :param registry_address: address of the registry contract (predefined)
         """
-        if network != 'mainnet':
-            fail('Only mainnet is supported at the moment')
+        check_network(network)
 
-        data = get_all_bakers(registry_address, indexer=indexer, raw=raw)
+        from bakers_registry.core import get_all_bakers, iter_all_bakers
+        from bakers_registry.cache import DiffCache
+
+        cache = None if no_cache else DiffCache()
+        if format == 'ndjson':
+            if output_file == '-':
+                disable_spinners()
+            bakers = iter_all_bakers(registry_address, indexer=indexer, raw=raw, cache=cache,
+                                     concurrency=concurrency, level=level, network=network, source=source)
+            write_ndjson((dict(address=address, **data) for address, data in bakers), output_file)
+            return
+
+        data = get_all_bakers(registry_address, indexer=indexer, raw=raw, cache=cache,
+                              concurrency=concurrency, level=level, network=network, source=source)
         with open(output_file, 'w+') as f:
             f.write(json.dumps(data, indent=4))
 
-    def log(self, output_file=None, since=None, raw=False,
-            indexer='tzkt', network='mainnet', registry_address='KT1ChNsEFxwyCbJyWGSL3KdjeXE28AY1Kaog'):
+    def log(self, output_file=None, since=None, raw=False, format='json', no_cache=False,
+            concurrency=DEFAULT_CONCURRENCY, follow=False, checkpoint_file=None, poll_interval=None, source='blocks',
+            workers=1, pipelined=False, indexer='tzkt', network='mainnet',
+            registry_address='KT1ChNsEFxwyCbJyWGSL3KdjeXE28AY1Kaog'):
         """
         Show registry changes, line by line
         :param output_file: path to the file
         :param since: set lower bound, can be level (int) or string "level:700000" "cycle:170".
             Default is "cycle:{current_cycle - 2}".
         :param raw: keep intermediate data representation (default is False)
+        :param format: output format [json, ndjson], ndjson streams entries in chronological order (default is json)
+        :param no_cache: do not use local cache of big map diffs (default is False)
+        :param concurrency: max number of RPC requests in flight (default is 50)
+        :param follow: keep running and print new changes as they land (default is False)
+        :param checkpoint_file: path to the file to store the last processed level in follow mode (optional)
+        :param poll_interval: seconds between head checks in follow mode (default is 30)
+        :param source: where big map diffs come from [blocks, indexer] (default is blocks)
+        :param workers: number of processes computing diffs, bakers are split between them (default is 1)
+        :param pipelined: fetch snapshot and blocks together, diff levels as they arrive (default is False)
         :param indexer: which indexer to use to retrieve operation levels [tzkt, tzstats, conseil]
-        :param network: Tezos network (default is mainnet)
+        :param network: mainnet or comma-separated urls of its RPC nodes (default is mainnet)
         :param registry_address: address of the registry contract (predefined)
         """
-        if network != 'mainnet':
-            fail('Only mainnet is supported at the moment')
+        check_network(network)
+
+        if pipelined and (source != 'blocks' or workers > 1):
+            fail('Pipelined mode cannot be combined with the indexer source or several workers')
+
+        from bakers_registry.core import get_unify_diff, iter_unify_diff
+        from bakers_registry.cache import DiffCache
+
+        if follow:
+            from bakers_registry.follow import follow_unify_diff, POLL_INTERVAL
+            if not output_file:
+                disable_spinners()
+            entries = follow_unify_diff(
+                registry_address=registry_address,
+                indexer=indexer,
+                since=since,
+                raw=raw,
+                network=network,
+                cache=None if no_cache else DiffCache(),
+                concurrency=concurrency,
+                checkpoint_file=checkpoint_file,
+                poll_interval=poll_interval or POLL_INTERVAL,
+                source=source)
+            try:
+                if format == 'ndjson' or output_file:
+                    write_ndjson(entries, output_file)
+                else:
+                    printer = PrinterLog()
+                    for entry in entries:
+                        printer.print_entry(entry, FOLLOW_BAKER_LENGTH)
+                        printer.flush()
+            except KeyboardInterrupt:
+                pass
+            return
+
+        if format == 'ndjson':
+            if not output_file:
+                disable_spinners()
+            entries = iter_unify_diff(
+                registry_address=registry_address,
+                indexer=indexer,
+                since=since,
+                raw=raw,
+                network=network,
+                cache=None if no_cache else DiffCache(),
+                concurrency=concurrency,
+                source=source,
+                workers=workers,
+                pipelined=pipelined)
+            write_ndjson(entries, output_file)
+            return
 
         log = get_unify_diff(
             registry_address=registry_address,
             indexer=indexer,
             since=since,
-            raw=raw)
+            raw=raw,
+            network=network,
+            cache=None if no_cache else DiffCache(),
+            concurrency=concurrency,
+            source=source,
+            workers=workers,
+            pipelined=pipelined)
         if output_file:
             with open(output_file, 'w+') as f:
                 f.write(json.dumps(log, indent=4))
         else:
             PrinterLog().print_log(log)
 
+    def query(self, *conditions, sort=None, limit=None, output_file=None, level=None, no_cache=False,
+              concurrency=DEFAULT_CONCURRENCY, source='blocks', indexer='tzkt', network='mainnet',
+              registry_address='KT1ChNsEFxwyCbJyWGSL3KdjeXE28AY1Kaog'):
+        """
+        Find bakers matching all the conditions, answered from the locally synced registry state if there is one
+        :param conditions: filters like "fee<=0.1", "minDelegation>100", "openForDelegation", "!payForStolenBlocks"
+        :param sort: numeric field to order by, prefixed with "-" for descending order (default is by address)
+        :param limit: max number of bakers to return (optional)
+        :param output_file: path to the file to store the data (optional)
+        :param level: registry state at the given level (default is the last synced one, or head)
+        :param no_cache: do not use local cache of big map diffs (default is False)
+        :param concurrency: max number of RPC requests in flight (default is 50)
+        :param source: where big map diffs come from [blocks, indexer] (default is blocks)
+        :param indexer: which indexer to use to retrieve operation levels [tzkt, tzstats, conseil]
+        :param network: mainnet or comma-separated urls of its RPC nodes (default is mainnet)
+        :param registry_address: address of the registry contract (predefined)
+        """
+        check_network(network)
+
+        from bakers_registry.core import query_bakers
+        from bakers_registry.cache import DiffCache
+
+        try:
+            bakers = query_bakers(registry_address, conditions=[str(x) for x in conditions], sort=sort, limit=limit,
+                                  indexer=indexer, cache=None if no_cache else DiffCache(),
+                                  concurrency=concurrency, level=level, network=network, source=source)
+        except ValueError as e:
+            fail(str(e))
+        else:
+            data = [dict(address=address, **config) for address, config in bakers]
+            if output_file:
+                with open(output_file, 'w+') as f:
+                    f.write(json.dumps(data, indent=4))
+            else:
+                info(data)
+
+    def serve(self, host='127.0.0.1', port=8080, sync_interval=60, no_cache=False, concurrency=DEFAULT_CONCURRENCY,
+              source='blocks', indexer='tzkt', network='mainnet',
+              registry_address='KT1ChNsEFxwyCbJyWGSL3KdjeXE28AY1Kaog'):
+        """
+        Serve registry state and changes over HTTP from memory, syncing in the background
+        :param host: interface to listen on (default is 127.0.0.1)
+        :param port: port to listen on (default is 8080)
+        :param sync_interval: seconds between background syncs (default is 60)
+        :param no_cache: do not use local cache of big map diffs (default is False)
+        :param concurrency: max number of RPC requests in flight (default is 50)
+        :param source: where big map diffs come from [blocks, indexer] (default is blocks)
+        :param indexer: which indexer to use to retrieve operation levels [tzkt, tzstats, conseil]
+        :param network: mainnet or comma-separated urls of its RPC nodes (default is mainnet)
+        :param registry_address: address of the registry contract (predefined)
+        """
+        check_network(network)
+
+        from bakers_registry.server import RegistryService, serve
+
+        service = RegistryService(registry_address, indexer=indexer, network=network, no_cache=no_cache,
+                                  concurrency=concurrency, sync_interval=sync_interval, source=source)
+        serve(service, host=host, port=port)
+
 
 def main():
     return fire.Fire(BakersRegistryCli)
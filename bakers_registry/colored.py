@@ -1,10 +1,12 @@
 import sys
+from typing import Iterable
 
 # Based on https://github.com/Miku-chan/printjson/
 
 COLOR_PREAMBLE = '\x1b[38;5;'
 C_RES = '\x1b[0m'
 COLORS_16 = [str(i) + 'm' for i in range(0, 16)]
+BUFFER_SIZE = 1 << 16
 
 
 class PrinterJSON:
@@ -23,42 +25,71 @@ class PrinterJSON:
     ind = 2
     onkey = True
 
-    def __init__(self):
+    def __init__(self, stream=None, colored=None):
+        """
+        :param stream: file to write to (default is stdout)
+        :param colored: use ANSI colors (default is True if the stream is a terminal)
+        """
         self.simple_data = None
+        self.stream = stream or sys.stdout
+        if colored is None:
+            colored = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.colored = colored
+        self.buffer = []
+        self.buffer_size = 0
+
+    def write(self, string):
+        """Buffer the string, the stream is written in large chunks"""
+        self.buffer.append(string)
+        self.buffer_size += len(string)
+        if self.buffer_size >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write everything buffered to the stream"""
+        if self.buffer:
+            self.stream.write(''.join(self.buffer))
+            self.buffer.clear()
+            self.buffer_size = 0
+        self.stream.flush()
 
     def set_color(self, num):
-        """Set output color of stdout to num"""
+        """Set output color to num"""
+        if not self.colored:
+            return
         if 0 < num < len(COLORS_16):
-            sys.stdout.write(COLOR_PREAMBLE + COLORS_16[num])
+            self.write(COLOR_PREAMBLE + COLORS_16[num])
         else:
-            sys.stdout.write(C_RES)
+            self.write(C_RES)
 
     def reset_color(self):
-        """Set output color of stdout to default"""
-        sys.stdout.write(C_RES)
+        """Set output color to default"""
+        if self.colored:
+            self.write(C_RES)
 
     def cpr(self, string, color_num):
         """Print colorized string"""
-        self.set_color(color_num)
-        sys.stdout.write(string)
-        self.reset_color()
+        if not self.colored:
+            self.write(string)
+        elif 0 < color_num < len(COLORS_16):
+            self.write(f'{COLOR_PREAMBLE}{COLORS_16[color_num]}{string}{C_RES}')
+        else:
+            self.write(f'{C_RES}{string}{C_RES}')
 
     def print_indent(self):
-        sys.stdout.write(' ' * self.curind)
+        self.write(' ' * self.curind)
 
     def end(self, p, c):
         self.cpr(p.replace('\n', '\n' + ' ' * self.curind), c)
 
     def print_bool(self, a):
         """Print bool or null variable"""
-        self.set_color(self.c_log)
         if a is True:
-            sys.stdout.write('true')
+            self.cpr('true', self.c_log)
         elif a is False:
-            sys.stdout.write('false')
+            self.cpr('false', self.c_log)
         elif a is None:
-            sys.stdout.write('null')
-        self.reset_color()
+            self.cpr('null', self.c_log)
 
     def print_num(self, a):
         """Print number."""
@@ -67,7 +98,7 @@ class PrinterJSON:
     def print_str(self, a):
         """Print string with colorized (if set) brackets"""
         if self.simple_data:
-            sys.stdout.write(a)
+            self.write(a)
         else:
             self.cpr(f'"{a}"', self.c_key if self.onkey else self.c_val)
 
@@ -127,29 +158,42 @@ class PrinterLog(PrinterJSON):
 
     def print_entry(self, entry, max_baker_length):
         if entry.get('level'):
-            sys.stdout.write(str(entry['level']))
-            sys.stdout.write('  ')
+            self.write(f'{entry["level"]}  ')
         if entry.get('baker'):
             self.cpr(entry['baker'].ljust(max_baker_length), 1)
-            sys.stdout.write('  ')
+            self.write('  ')
 
         if entry['kind'] == 'create':
             self.cpr(f'New Baker: {entry["address"]}', 1)
+        elif 'address' in entry:
+            self.cpr(f'Removed Baker: {entry["address"]}', 1)
         else:
             self.simple_data = False
             self.cpr(entry['key'], 6)
-            sys.stdout.write(': ')
+            self.write(': ')
             self.print_data(entry['before'])
-            sys.stdout.write(' => ')
+            self.write(' => ')
             self.print_data(entry['after'])
             self.simple_data = True
 
-        sys.stdout.write('\n')
-
-    def print_log(self, entries: list):
-        if entries:
-            max_baker_length = max(map(lambda x: len(x.get('baker', '')), entries))
-            for entry in entries:
-                self.print_entry(entry, max_baker_length)
-        else:
+        self.write('\n')
+
+    def print_log(self, entries: Iterable[dict], max_baker_length=None):
+        """
+        Print log entries, aligning baker names
+        :param entries: list of entries, or any iterable to print them as they come
+        :param max_baker_length: initial width of the baker column; if not set and entries is a list, \
+            the longest name is used, otherwise the column grows as longer names arrive
+        """
+        if max_baker_length is None and isinstance(entries, list):
+            max_baker_length = max(map(lambda x: len(x.get('baker', '')), entries), default=0)
+        max_baker_length = max_baker_length or 0
+
+        empty = True
+        for entry in entries:
+            max_baker_length = max(max_baker_length, len(entry.get('baker', '')))
+            self.print_entry(entry, max_baker_length)
+            empty = False
+        if empty:
             self.cpr('No changes\n', 2)
+        self.flush()
@@ -1,182 +1,614 @@
+import asyncio
+import heapq
+import queue
 import requests
+import threading
+import simplejson as json
 from decimal import Decimal
-from typing import List, Tuple
-from pytezos import pytezos
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from pytezos import pytezos, ContractInterface
+from pytezos.michelson.format import micheline_to_michelson
 from pytezos.rpc.errors import RpcError
 from conseil import conseil
-from concurrent.futures import ThreadPoolExecutor
-from functools import reduce
-from jsondiff import diff
-from jsondiff.symbols import insert, delete
-from yaspin import yaspin
-
-from bakers_registry.encoding import decode_info, decode_snapshot, encode_info, decode_hex
-
-LIMIT = 1000  # TODO: change me
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import repeat
+
+from bakers_registry.encoding import decode_snapshot, encode_info, decode_hex, parse_indexer_info, \
+    decode_record, BakerInfo, PAYMENT_CONFIG_BITS
+from bakers_registry.cache import DiffCache, FINALITY_DEPTH
+from bakers_registry.rpc import RpcEngine, DEFAULT_CONCURRENCY
+from bakers_registry.state import RegistryState
+from bakers_registry.history import RegistryHistory
+from bakers_registry.query import RegistryIndex
+from bakers_registry.transport import get_transport
+from bakers_registry.metrics import stage
+
+PAGE_SIZE = 1000
+CONSEIL_RANGE = 100000
+CONCURRENCY = 10
+BULK_THRESHOLD = 10
 CREATE_FEE = Decimal('1.5')
 UPDATE_FEE = Decimal('0.5')
 
 
-def get_update_levels_tzkt(address):
-    res = requests.get(f'https://api.tzkt.io/v1/Accounts/{address}/operations',
-                       params=dict(limit=LIMIT)).json()
-    return set(map(lambda x: x['level'], res))
-
-
-def get_update_levels_tzstats(address):
-    res = requests.get(f'https://api.tzstats.com/tables/op',
-                       params=dict(receiver=address,
-                                   limit=LIMIT,
-                                   columns='height',
-                                   status='applied')).json()
-    return set(map(lambda x: x[0], res))
-
-
-def get_update_levels_conseil(address):
+def iter_pages(fetch_page, concurrency=CONCURRENCY) -> Iterator:
+    """
+    Fetch offset-paginated pages, several at a time, until a short page is returned
+    :param fetch_page: function that takes an offset and returns a list of at most PAGE_SIZE items
+    :param concurrency: max number of pages in flight
+    """
+    page = fetch_page(0)
+    yield from page
+    if len(page) < PAGE_SIZE:
+        return
+
+    offset = PAGE_SIZE
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            offsets = [offset + i * PAGE_SIZE for i in range(concurrency)]
+            pages = list(executor.map(fetch_page, offsets))
+            for page in pages:
+                yield from page
+            if any(len(page) < PAGE_SIZE for page in pages):
+                break
+            offset = offsets[-1] + PAGE_SIZE
+
+
+def get_update_operations_tzkt(address, since=None) -> Iterator[Tuple[int, Optional[str]]]:
+    params = {'target': address, 'status': 'applied', 'select': 'level,hash', 'sort.asc': 'id'}
+    if since is not None:
+        params['level.gt'] = since
+
+    def fetch_page(offset):
+        return get_transport().get_json('https://api.tzkt.io/v1/operations/transactions',
+                                        params=dict(params, offset=offset, limit=PAGE_SIZE))
+
+    contract = get_transport().get_json(f'https://api.tzkt.io/v1/contracts/{address}')
+    yield contract['firstActivity'], None
+    yield from map(lambda x: (x['level'], x['hash']), iter_pages(fetch_page))
+
+
+def get_update_operations_tzstats(address, since=None) -> Iterator[Tuple[int, Optional[str]]]:
+    params = dict(receiver=address, limit=PAGE_SIZE, columns='row_id,height,hash', status='applied')
+    if since is not None:
+        params['height.gt'] = since
+
+    cursor = 0
+    while True:
+        res = get_transport().get_json('https://api.tzstats.com/tables/op', params=dict(params, cursor=cursor))
+        yield from map(lambda x: (x[1], x[2]), res)
+        if len(res) < PAGE_SIZE:
+            break
+        cursor = res[-1][0]
+
+
+def get_update_operations_conseil(address, since=None) -> Iterator[Tuple[int, Optional[str]]]:
+    """Conseil vectors carry a single field, so only levels are known"""
     Operation = conseil.using('prod').tezos.mainnet.operations
+    Block = conseil.using('prod').tezos.mainnet.blocks
 
-    tx_levels = Operation.query(Operation.block_level) \
-        .filter(Operation.destination == address,
-                Operation.status == 'applied') \
-        .limit(LIMIT) \
-        .vector()
-
-    orig_level = Operation.query(Operation.block_level) \
+    orig_level = get_transport().call(
+        f'conseil origination {address}',
+        lambda: Operation.query(Operation.block_level)
         .filter(Operation.originated_contracts == address,
-                Operation.status == 'applied') \
-        .scalar()
-
-    return set([orig_level] + tx_levels)
-
-
-def get_update_levels(address, indexer, since=None) -> List[int]:
+                Operation.status == 'applied')
+        .scalar())
+    head_level = get_transport().call(
+        'conseil head',
+        lambda: Block.query(Block.level)
+        .order_by(Block.level.desc())
+        .limit(1)
+        .scalar())
+
+    def fetch_range(bounds):
+        start, end = bounds
+        tx_levels = get_transport().call(
+            f'conseil transactions {address} {start} {end}',
+            lambda: Operation.query(Operation.block_level)
+            .filter(Operation.destination == address,
+                    Operation.status == 'applied',
+                    Operation.block_level >= start,
+                    Operation.block_level < end)
+            .limit(PAGE_SIZE)
+            .vector())
+        if len(tx_levels) == PAGE_SIZE and end - start > 1:
+            middle = (start + end) // 2
+            return fetch_range((start, middle)) + fetch_range((middle, end))
+        return tx_levels
+
+    yield orig_level, None
+    first_level = orig_level if since is None else max(orig_level, since + 1)
+    ranges = [(start, min(start + CONSEIL_RANGE, head_level + 1))
+              for start in range(first_level, head_level + 1, CONSEIL_RANGE)]
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        for tx_levels in executor.map(fetch_range, ranges):
+            yield from map(lambda x: (x, None), tx_levels)
+
+
+def parse_since(since) -> int:
+    if isinstance(since, str):
+        kind, value = since.split(':')
+        if kind == 'level':
+            return int(value)
+        elif kind == 'cycle':
+            return int(value) * 4096
+        # elif kind == 'time': TODO
+        # elif kind == 'date':
+        else:
+            assert False, kind
+    assert isinstance(since, int), since
+    return since
+
+
+def get_update_operations(address, indexer, since=None) -> Dict[int, Optional[Set[str]]]:
+    """
+    Levels at which the contract was called, newest first
+    :param since: only levels above it are requested from the indexer
+    :returns: {level: hashes of the operation groups calling the contract, or None if the indexer did not tell}
+    """
     indexers = {
-        'tzkt': get_update_levels_tzkt,
-        'tzstats': get_update_levels_tzstats,
-        'conseil': get_update_levels_conseil
+        'tzkt': get_update_operations_tzkt,
+        'tzstats': get_update_operations_tzstats,
+        'conseil': get_update_operations_conseil
     }
 
-    with yaspin(text=f"Retrieving operation levels from {indexer}..."):
-        update_levels = indexers[indexer](address)
-        update_levels = list(sorted(update_levels, reverse=True))
-        if since:
-            if isinstance(since, str):
-                kind, value = since.split(':')
-                if kind == 'level':
-                    since = int(value)
-                elif kind == 'cycle':
-                    since = int(value) * 4096
-                # elif kind == 'time': TODO
-                # elif kind == 'date':
-                else:
-                    assert False, kind
+    with stage('Retrieving operation levels', f'Retrieving operation levels from {indexer}...'):
+        since = parse_since(since) if since else None
+        operations = dict()
+        for level, opg_hash in indexers[indexer](address, since=since):
+            if opg_hash is None:
+                operations[level] = None
+            elif operations.get(level, set()) is not None:
+                operations.setdefault(level, set()).add(opg_hash)
+
+        update_levels = [level for level in sorted(operations, reverse=True) if since is None or level > since]
+
+    return {level: operations[level] for level in update_levels}
+
+
+async def load_registry(engine: RpcEngine, registry_address) -> ContractInterface:
+    """Build registry contract interface from its script, fetched through the engine"""
+    script = await engine.contract_script(registry_address)
+    return ContractInterface.from_micheline(script['code'])
+
+
+def decode_big_map_value(registry: ContractInterface, value) -> dict:
+    """Decode raw registry big map value (Micheline) into the raw format"""
+    value_type = type(registry.storage['big_map_0'].data).args[1]
+    return value_type.from_micheline_value(value).to_python_object()
+
+
+def iter_big_map_updates(opg: dict, address) -> Iterator[Tuple[dict, Optional[dict]]]:
+    """
+    Raw (key, value) updates of the contract big map made by the applied operations of the group,
+    value is None if the key is removed. Both lazy storage diffs and legacy big map diffs are understood.
+    """
+    for content in opg['contents']:
+        metadata = content.get('metadata', {})
+        results = [(content, metadata.get('operation_result', {}))]
+        results.extend((x, x.get('result', {})) for x in metadata.get('internal_operation_results', []))
+        for operation, result in results:
+            if result.get('status', 'applied') != 'applied':
+                continue
+            if operation.get('destination') != address and address not in result.get('originated_contracts', []):
+                continue
+            if 'lazy_storage_diff' in result:
+                for item in result['lazy_storage_diff']:
+                    if item['kind'] == 'big_map' and not item['id'].startswith('-'):
+                        for update in item['diff'].get('updates', []):
+                            yield update['key'], update.get('value')
             else:
-                assert isinstance(since, int), since
-            update_levels = list(filter(lambda x: x > since, update_levels))
-
-    return update_levels
-
-
-def get_updates(registry_address, indexer, since=None) -> List[Tuple[int, dict]]:
-    update_levels = get_update_levels(registry_address, indexer=indexer, since=since)
-
-    with yaspin(text=f"Retrieving big map diffs since {since or 'origination'}..."):
-        baker_registry = pytezos.using('mainnet').contract(registry_address)
-
-        def parse_updates(level):
-            big_map_diff = dict()
-            opg_list = baker_registry.shell.blocks[level].operations.managers()
-            for opg in opg_list:
-                try:
-                    results = baker_registry.operation_result(opg)
-                    for result in results:
-                        print(result.storage)
-                        big_map_diff.update(**result.storage['big_map_0'])
-                except RpcError:
-                    pass
-            return level, big_map_diff
+                for item in result.get('big_map_diff', []):
+                    if item.get('action', 'update') == 'update' and not str(item.get('big_map', '')).startswith('-'):
+                        yield item['key'], item.get('value')
+
+
+def calls_contract(opg: dict, address) -> bool:
+    """Whether the operation group successfully calls or originates the contract, judging by the raw JSON only"""
+    for content in opg['contents']:
+        metadata = content.get('metadata', {})
+        if metadata.get('operation_result', {}).get('status', 'applied') != 'applied':
+            continue
+        if content.get('destination') == address:
+            return True
+        if address in metadata.get('operation_result', {}).get('originated_contracts', []):
+            return True
+        if any(x.get('destination') == address for x in metadata.get('internal_operation_results', [])):
+            return True
+    return False
+
+
+async def fetch_operations(engine: RpcEngine, level, opg_hashes: Set[str] = None, registry_address=None) -> list:
+    """
+    Fetch manager operations of the block that may touch the registry
+    :param opg_hashes: if set, only these operation groups are downloaded (one by one, by index in the block)
+    :param registry_address: if set, skip operations that do not call the registry contract
+    """
+    if opg_hashes:
+        block_hashes = await engine.operation_hashes(level)
+        indices = [i for i, opg_hash in enumerate(block_hashes) if opg_hash in opg_hashes]
+        if len(indices) == len(opg_hashes):
+            return list(await asyncio.gather(*(engine.manager_operation(level, i) for i in indices)))
+
+    opg_list = await engine.manager_operations(level)
+    if registry_address:
+        opg_list = [opg for opg in opg_list if calls_contract(opg, registry_address)]
+    return opg_list
+
+
+async def fetch_big_map_diff(engine: RpcEngine, registry: ContractInterface, level, registry_address,
+                             opg_hashes: Set[str] = None) -> Tuple[int, dict]:
+    """
+    Parse big map diff of the registry operations in the block
+    :param opg_hashes: if known, only these operation groups are fetched and parsed
+    """
+    key_type = type(registry.storage['big_map_0'].data).args[0]
+    big_map_diff = dict()
+    for opg in await fetch_operations(engine, level, opg_hashes=opg_hashes, registry_address=registry_address):
+        for key, value in iter_big_map_updates(opg, registry_address):
+            address = key_type.from_micheline_value(key).to_python_object()
+            big_map_diff[address] = None if value is None else decode_big_map_value(registry, value)
+    return level, big_map_diff
+
+
+def get_big_map_updates_tzkt(registry_address, since=None) -> Tuple[List[Tuple[int, dict]], int]:
+    """
+    Registry big map key updates from tzkt, grouped by level
+    :returns: [(level, big map diff)] in level order, indexer head level
+    """
+    head_level = get_transport().get_json('https://api.tzkt.io/v1/head')['level']
+    bigmaps = get_transport().get_json(f'https://api.tzkt.io/v1/contracts/{registry_address}/bigmaps')
+    url = 'https://api.tzkt.io/v1/bigmaps/updates'
+    params = {'bigmap': bigmaps[0]['ptr'], 'sort.asc': 'id'}
+    if since:
+        params['level.gt'] = parse_since(since)
 
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            updates = list(executor.map(parse_updates, update_levels))
+    def fetch_page(offset):
+        return get_transport().get_json(url, params=dict(params, offset=offset, limit=PAGE_SIZE))
 
-    return updates
+    updates = dict()
+    for item in iter_pages(fetch_page):
+        if item['action'] == 'remove_key':
+            updates.setdefault(item['level'], {})[item['content']['key']] = None
+        elif item['action'] in ['add_key', 'update_key']:
+            updates.setdefault(item['level'], {})[item['content']['key']] = parse_indexer_info(item['content']['value'])
+    return list(updates.items()), head_level
 
 
-def get_snapshot(registry_address, bakers_addresses: list, raw=False, level=None, network='mainnet') -> dict:
-    with yaspin(text=f'Retrieving big map snapshot at {level or "head"}...'):
-        registry = pytezos.using(network).contract(registry_address)
+def get_indexer_updates(registry_address, indexer, since=None, network='mainnet',
+                        cache: DiffCache = None) -> List[Tuple[int, dict]]:
+    """Same as get_updates, but big map diffs are taken from the indexer in bulk instead of parsing blocks"""
+    big_map_history_indexers = {
+        'tzkt': get_big_map_updates_tzkt
+    }
+    if indexer not in big_map_history_indexers:
+        raise ValueError(f'{indexer} does not provide big map history, '
+                         f'choose one of {", ".join(big_map_history_indexers)}')
+
+    with stage('Retrieving big map updates',
+               f"Retrieving big map updates from {indexer} since {since or 'origination'}..."):
+        updates, head_level = big_map_history_indexers[indexer](registry_address, since=since)
+        if cache and updates:
+            cache.put_many(network, registry_address, updates, head_level=head_level)
+
+    return list(reversed(updates))
+
+
+def get_updates(registry_address, indexer, since=None, network='mainnet',
+                cache: DiffCache = None, concurrency=DEFAULT_CONCURRENCY, source='blocks') -> List[Tuple[int, dict]]:
+    """
+    Big map diffs of the registry, newest first
+    :param source: where diffs come from: blocks (parsed from operations fetched from the node) \
+        or indexer (big map history, a few bulk requests)
+    """
+    if source == 'indexer':
+        return get_indexer_updates(registry_address, indexer=indexer, since=since, network=network, cache=cache)
+    assert source == 'blocks', source
+
+    update_operations = get_update_operations(registry_address, indexer=indexer, since=since)
+    update_levels = list(update_operations)
+
+    with stage('Retrieving big map diffs', f"Retrieving big map diffs since {since or 'origination'}..."):
+        cached = cache.get_many(network, registry_address, update_levels) if cache else {}
+        missing_levels = [level for level in update_levels if level not in cached]
+
+        async def fetch_updates():
+            async with RpcEngine(network, concurrency=concurrency) as engine:
+                if not missing_levels:
+                    return [], None
+                baker_registry = await load_registry(engine, registry_address)
+                updates = await engine.map(
+                    lambda x: fetch_big_map_diff(engine, baker_registry, x, registry_address=registry_address,
+                                                 opg_hashes=update_operations[x]),
+                    missing_levels)
+                head_level = (await engine.head_header())['level'] if updates else None
+                return updates, head_level
+
+        fetched, head_level = asyncio.run(fetch_updates())
+        if cache and fetched:
+            cache.put_many(network, registry_address, fetched, head_level=head_level)
+
+    cached.update(fetched)
+    return [(level, cached[level]) for level in update_levels]
+
+
+def iter_updates_pipelined(registry_address, update_operations: Dict[int, Optional[Set[str]]], network='mainnet',
+                           cache: DiffCache = None, concurrency=DEFAULT_CONCURRENCY) -> Iterator[Tuple[int, dict]]:
+    """
+    Big map diffs of the registry in level order, each one yielded as soon as all lower levels are available.
+    Blocks are fetched lowest level first in a background thread, cache is only touched from the calling thread.
+    The download starts on call, not when the first diff is requested, so that other stages can overlap with it.
+    :param update_operations: {level: operation group hashes or None}, as returned by get_update_operations
+    """
+    levels = list(sorted(update_operations))
+    ready = cache.get_many(network, registry_address, levels) if cache else {}
+    missing_levels = [level for level in levels if level not in ready]
+    done = queue.Queue()
+
+    async def fetch_updates():
+        async with RpcEngine(network, concurrency=concurrency) as engine:
+            baker_registry = await load_registry(engine, registry_address)
+
+            async def fetch_update(level):
+                update = await fetch_big_map_diff(engine, baker_registry, level, registry_address=registry_address,
+                                                  opg_hashes=update_operations[level])
+                done.put(update)
+
+            await engine.map(fetch_update, missing_levels)
+            return (await engine.head_header())['level']
+
+    def run():
+        try:
+            done.put((None, asyncio.run(fetch_updates())))
+        except Exception as e:
+            done.put(e)
+
+    if missing_levels:
+        threading.Thread(target=run, daemon=True).start()
+
+    def iter_ready():
+        fetched = list()
+        for level in levels:
+            while level not in ready:
+                item = done.get()
+                if isinstance(item, Exception):
+                    raise item
+                fetched.append(item)
+                ready[item[0]] = item[1]
+            yield level, ready.pop(level)
+
+        if missing_levels:
+            item = done.get()
+            if isinstance(item, Exception):
+                raise item
+            if cache:
+                cache.put_many(network, registry_address, fetched, head_level=item[1])
+
+    return iter_ready()
+
+
+def get_big_map_tzkt(registry_address, level=None) -> dict:
+    bigmaps = get_transport().get_json(f'https://api.tzkt.io/v1/contracts/{registry_address}/bigmaps')
+    ptr = bigmaps[0]['ptr']
+    url = f'https://api.tzkt.io/v1/bigmaps/{ptr}/historical_keys/{level}' if level \
+        else f'https://api.tzkt.io/v1/bigmaps/{ptr}/keys'
+
+    def fetch_page(offset):
+        return get_transport().get_json(url, params=dict(active='true', offset=offset, limit=PAGE_SIZE))
+
+    return {item['key']: parse_indexer_info(item['value']) for item in iter_pages(fetch_page)}
+
+
+def format_info(data, raw=False):
+    if raw:
+        for key in ['last_update', 'reporterAccount']:
+            if key in data:
+                del data[key]
+        return data
+    return decode_record(data)
+
+
+def get_snapshot(registry_address, bakers_addresses: list, raw=False, level=None, network='mainnet',
+                 concurrency=DEFAULT_CONCURRENCY, indexer=None) -> dict:
+    bulk_snapshot_indexers = {
+        'tzkt': get_big_map_tzkt
+    }
 
-        def big_map_get(address):
+    with stage('Retrieving big map snapshot', f'Retrieving big map snapshot at {level or "head"}...'):
+        snapshot = dict()
+        if indexer in bulk_snapshot_indexers and len(bakers_addresses) > BULK_THRESHOLD:
             try:
-                data = registry.using(block_id=level or 'head').storage['big_map_0'][address]()
-            except AssertionError:
-                data = None
-            else:
-                if raw:
-                    for key in ['last_update', 'reporterAccount']:
-                        if key in data:
-                            del data[key]
-                else:
-                    data = decode_info(data)
-
-            return address, data
-
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            snapshot = dict(executor.map(big_map_get, bakers_addresses))
-
-    return {k: v for k, v in snapshot.items() if v is not None}
-
-
-def get_all_bakers(registry_address, indexer='tzkt', raw=False) -> dict:
-    updates = get_updates(registry_address, indexer=indexer)
-
-    def merge_updates(a: tuple, b: tuple):
-        keys = set(a[1].keys()).union(set(b[1].keys()))
-        res = dict()
-        for key in keys:
-            if key in a[1] and key not in b[1]:
-                res[key] = a[1][key]
-            elif key in b[1] and key not in a[1]:
-                res[key] = b[1][key]
-            elif a[0] > b[0]:
-                res[key] = a[1][key]
-            else:
-                res[key] = b[1][key]
-        return max(a[0], b[0]), res
-
-    with yaspin(text='Merging updates...'):
-        _, data = reduce(merge_updates, updates)
-        if not raw:
-            data = decode_snapshot(data)
-
-    return data
-
-
-def iter_diff(node, root_key=''):
-    if isinstance(node, dict):
-        for key, value in node.items():
-            if isinstance(key, str):
-                yield from iter_diff(value, key)
-            elif key in [insert, delete]:
-                if isinstance(value, list):
-                    for key_index, item in value:
-                        yield (root_key,
-                               None if key == insert else item,
-                               item if key == insert else None)
-                elif isinstance(value, dict):
-                    for sub_key, item in value.items():
-                        yield (sub_key,
-                               None if key == insert else item,
-                               item if key == insert else None)
-                else:
-                    assert False, value
-            else:
-                assert False, key
-    elif isinstance(node, list):
-        assert len(node) == 2, node
-        yield root_key, node[0], node[1]
+                big_map = bulk_snapshot_indexers[indexer](registry_address, level=level)
+            except (RpcError, requests.RequestException, ValueError, KeyError, IndexError):
+                big_map = dict()
+            snapshot = {address: big_map[address] for address in bakers_addresses if address in big_map}
+
+        stragglers = [address for address in bakers_addresses if address not in snapshot]
+        if stragglers:
+            async def fetch_snapshot():
+                async with RpcEngine(network, concurrency=concurrency) as engine:
+                    registry = await load_registry(engine, registry_address)
+
+                    async def big_map_get(address):
+                        value = await engine.big_map_get(
+                            contract_address=registry_address,
+                            query=dict(key={'string': address}, type={'prim': 'address'}),
+                            block_id=level or 'head')
+                        if value is not None:
+                            value = decode_big_map_value(registry, value)
+                        return address, value
+
+                    return await engine.map(big_map_get, stragglers)
+
+            snapshot.update(asyncio.run(fetch_snapshot()))
+
+    return {k: format_info(v, raw=raw) for k, v in snapshot.items() if v is not None}
+
+
+def get_head_cycle(network='mainnet') -> int:
+    async def fetch_cycle():
+        async with RpcEngine(network) as engine:
+            metadata = await engine.head_metadata()
+            return metadata['level']['cycle']
+
+    return asyncio.run(fetch_cycle())
+
+
+def get_head_level(network='mainnet') -> int:
+    async def fetch_level():
+        async with RpcEngine(network) as engine:
+            header = await engine.head_header()
+            return header['level']
+
+    return asyncio.run(fetch_level())
+
+
+def get_registry_state(registry_address, indexer='tzkt', cache: DiffCache = None,
+                       concurrency=DEFAULT_CONCURRENCY, level=None, network='mainnet',
+                       source='blocks') -> RegistryState:
+    """
+    Build registry state at the given level (head by default).
+    If the local history is already synced past the level, it is replayed from the nearest checkpoint offline.
+    """
+    history = RegistryHistory(cache, network, registry_address) if cache else None
+    if level is not None and history and level <= history.synced_level:
+        with stage('Replaying history', f'Replaying history up to {level}...'):
+            return history.state_at(level)
+
+    head_level = get_head_level(network) if history else None
+    updates = get_updates(registry_address, indexer=indexer, network=network, cache=cache, concurrency=concurrency,
+                          source=source)
+    if history:
+        with stage('Materializing checkpoints'):
+            history.mark_synced(head_level - FINALITY_DEPTH)
+
+    if level is not None:
+        updates = [x for x in updates if x[0] <= level]
+    with stage('Merging updates'):
+        return RegistryState.from_updates(updates)
+
+
+def iter_all_bakers(registry_address, indexer='tzkt', raw=False, cache: DiffCache = None,
+                    concurrency=DEFAULT_CONCURRENCY, level=None, network='mainnet',
+                    source='blocks') -> Iterator[Tuple[str, dict]]:
+    """Build registry state eagerly, then decode baker records one at a time"""
+    state = get_registry_state(registry_address, indexer=indexer, cache=cache, concurrency=concurrency, level=level,
+                               network=network, source=source)
+    if raw:
+        return iter(state.bakers.items())
+    memo = dict()
+    return ((address, decode_record(info, memo).to_dict()) for address, info in state.bakers.items())
+
+
+def get_all_bakers(registry_address, indexer='tzkt', raw=False, cache: DiffCache = None,
+                   concurrency=DEFAULT_CONCURRENCY, level=None, network='mainnet', source='blocks') -> dict:
+    return dict(iter_all_bakers(registry_address, indexer=indexer, raw=raw, cache=cache,
+                                concurrency=concurrency, level=level, network=network, source=source))
+
+
+def query_bakers(registry_address, conditions: list, sort=None, limit=None, indexer='tzkt',
+                 cache: DiffCache = None, concurrency=DEFAULT_CONCURRENCY, level=None, network='mainnet',
+                 source='blocks') -> List[Tuple[str, dict]]:
+    """
+    Find bakers matching all the conditions using field indexes over the registry state.
+    Without a level the locally synced state is used if there is one, so no network requests are made,
+    and its indexes are loaded from the local history instead of being rebuilt.
+    """
+    history = RegistryHistory(cache, network, registry_address) if cache else None
+    if level is None and history and history.synced_level:
+        level = history.synced_level
+
+    if level is not None and history and level <= history.synced_level:
+        with stage('Loading indexes', f'Loading indexes at {level}...'):
+            index = history.index_at(level)
     else:
-        assert False, node
+        state = get_registry_state(registry_address, indexer=indexer, cache=cache, concurrency=concurrency,
+                                   level=level, network=network, source=source)
+        index = RegistryIndex(decode_snapshot(state.bakers))
+    return [(address, record.to_dict()) for address, record in index.query(conditions, sort=sort, limit=limit)]
+
+
+def iter_list_diff(key, before: list, after: list):
+    """
+    Compare lists the way jsondiff does (symmetric syntax): items are matched in order (LCS),
+    the whole value is replaced if none is kept, otherwise inserted items are followed by removed ones
+    """
+    if before == after:
+        return
+
+    lengths = [[0] * (len(after) + 1) for _ in range(len(before) + 1)]
+    for i, before_item in enumerate(before, 1):
+        for j, after_item in enumerate(after, 1):
+            lengths[i][j] = max(lengths[i][j - 1], lengths[i - 1][j],
+                                lengths[i - 1][j - 1] + (before_item == after_item))
+    if not lengths[-1][-1]:
+        yield key, before, after
+        return
+
+    inserted, removed = list(), list()
+    i, j = len(before), len(after)
+    while i or j:
+        if i and j and before[i - 1] == after[j - 1] and lengths[i][j] == lengths[i - 1][j - 1] + 1:
+            i, j = i - 1, j - 1
+        elif j and (not i or lengths[i][j - 1] >= lengths[i - 1][j]):
+            inserted.append(after[j - 1])
+            j -= 1
+        else:
+            removed.append(before[i - 1])
+            i -= 1
+
+    for item in reversed(inserted):
+        yield key, None, item
+    for item in removed:
+        yield key, item, None
+
+
+def iter_record_diff(before: BakerInfo, after: BakerInfo) -> Iterator[Tuple[str, object, object]]:
+    for key in BakerInfo.__slots__:
+        before_value, after_value = getattr(before, key), getattr(after, key)
+        if key == 'paymentConfigMask':
+            changed = before_value ^ after_value
+            if changed:
+                for flag, bit, inverted in PAYMENT_CONFIG_BITS:
+                    if changed & bit:
+                        before_flag = bool(before_value & bit) != inverted
+                        yield flag, before_flag, not before_flag
+        elif key == 'bakerPaysFromAccounts':
+            yield from iter_list_diff(key, before_value, after_value)
+        elif before_value != after_value:
+            yield key, before_value, after_value
+
+
+def iter_diff(before, after) -> Iterator[Tuple[str, object, object]]:
+    """
+    Field-wise diff of two baker records, either BakerInfo or dicts (raw or decoded, see encoding.decode_info)
+    :returns: generator of (key, value before, value after), None stands for a missing value
+    """
+    if isinstance(before, BakerInfo):
+        yield from iter_record_diff(before, after)
+        return
+
+    for key, after_value in after.items():
+        if key not in before:
+            if after_value is not None:
+                yield key, None, after_value
+            continue
+
+        before_value = before[key]
+        if key == 'data':
+            yield from iter_diff(before_value, after_value)
+        elif key == 'paymentConfig':
+            for flag, _, _ in PAYMENT_CONFIG_BITS:
+                if before_value[flag] != after_value[flag]:
+                    yield flag, before_value[flag], after_value[flag]
+        elif key == 'bakerPaysFromAccounts':
+            yield from iter_list_diff(key, before_value, after_value)
+        elif before_value != after_value:
+            yield key, before_value, after_value
+
+    for key, before_value in before.items():
+        if key not in after and before_value is not None:
+            yield key, before_value, None
 
 
 def format_entry(entry, level=0, baker=''):
@@ -204,14 +636,129 @@ def flat_list(list_of_lists):
     return [item for sublist in list_of_lists for item in sublist]
 
 
-def get_unify_diff(registry_address, indexer='tzkt', since=None, raw=False) -> list:
+def iter_update_items(updates: List[Tuple[int, dict]]) -> Iterator[Tuple[int, int, str, dict]]:
+    """Flatten big map diffs into (level, position within the level, address, big map value)"""
+    for level, update in updates:
+        for position, (address, info) in enumerate(update.items()):
+            yield level, position, address, info
+
+
+def iter_keyed_entries(items, snapshot: dict, raw=False) -> Iterator[Tuple[Tuple[int, int], dict]]:
+    """
+    Yield log entries keyed by (level, position) for big map values applied on top of the snapshot
+    :param items: (level, position, address, big map value) in level order
+    :param snapshot: baker states before the first update, modified in place
+    :param raw: keep intermediate data representation
+    """
+    memo = dict()
+    for level, position, address, info in items:
+        if info is None:
+            if address in snapshot:
+                before = snapshot.pop(address)
+                yield (level, position), dict(
+                    level=level,
+                    baker=decode_hex(before['data']['bakerName']) if raw else before.bakerName,
+                    kind='remove',
+                    address=address
+                )
+            continue
+
+        if raw:
+            info.pop('last_update')
+            baker = decode_hex(info['data']['bakerName'])
+        else:
+            info = decode_record(info, memo)
+            baker = info.bakerName
+
+        if address in snapshot:
+            for entry in iter_diff(snapshot[address], info):
+                yield (level, position), format_entry(entry, level, baker)
+        else:
+            yield (level, position), dict(
+                level=level,
+                baker=baker,
+                kind='create',
+                address=address
+            )
+
+        snapshot[address] = info
+
+
+def diff_partition(items: list, snapshot: dict, raw=False) -> Tuple[list, dict]:
+    """Worker task: diff the chains of a subset of bakers, returns keyed entries and the bakers' final states"""
+    entries = list(iter_keyed_entries(items, snapshot, raw=raw))
+    return entries, snapshot
+
+
+def partition_items(updates: List[Tuple[int, dict]], snapshot: dict, parts: int) -> List[Tuple[list, dict]]:
+    """
+    Split big map values by baker, so that each baker's chain lands in a single part,
+    the longest chains are placed first into the least loaded part
+    :returns: [(items in level order, snapshot of the part's bakers)]
+    """
+    chains = dict()
+    for item in iter_update_items(updates):
+        chains.setdefault(item[2], []).append(item)
+
+    partitions = [(list(), dict()) for _ in range(min(parts, len(chains)))]
+    for address in sorted(chains, key=lambda x: len(chains[x]), reverse=True):
+        items, part_snapshot = min(partitions, key=lambda x: len(x[0]))
+        items.extend(chains[address])
+        if address in snapshot:
+            part_snapshot[address] = snapshot[address]
+
+    for items, _ in partitions:
+        items.sort(key=lambda x: x[:2])
+    return partitions
+
+
+def diff_updates(updates: List[Tuple[int, dict]], snapshot: dict, raw=False, workers=1) -> Iterator[dict]:
+    """
+    Yield log entries for big map diffs applied on top of the snapshot, in level order
+    :param updates: list of (level, big map diff) sorted by level
+    :param snapshot: baker states before the first update, modified in place
+    :param raw: keep intermediate data representation
+    :param workers: number of processes, bakers are split between them and the entries are merged back by level
+    """
+    if workers <= 1:
+        yield from (entry for _, entry in iter_keyed_entries(iter_update_items(updates), snapshot, raw=raw))
+        return
+
+    partitions = partition_items(updates, snapshot, workers)
+    if not partitions:
+        return
+
+    with ProcessPoolExecutor(max_workers=len(partitions)) as executor:
+        results = list(executor.map(diff_partition, *zip(*partitions), repeat(raw, len(partitions))))
+
+    for (items, _), (_, states) in zip(partitions, results):
+        snapshot.update(states)
+        for address in {item[2] for item in items} - states.keys():
+            snapshot.pop(address, None)
+    yield from (entry for _, entry in heapq.merge(*(entries for entries, _ in results), key=lambda x: x[0]))
+
+
+def iter_unify_diff(registry_address, indexer='tzkt', since=None, raw=False, network='mainnet', cache: DiffCache = None,
+                    concurrency=DEFAULT_CONCURRENCY, source='blocks', workers=1, pipelined=False) -> Iterator[dict]:
+    """
+    Fetch updates and the baseline snapshot eagerly, then yield log entries in level order
+    :param pipelined: overlap the stages instead, see iter_unify_diff_pipelined
+    """
     if since is None:
-        with yaspin(text=f"Getting current cycle..."):
-            since = f'cycle:{pytezos.using("mainnet").shell.head.cycle() - 2}'
-
-    updates = get_updates(registry_address, indexer=indexer, since=since)
+        with stage('Getting current cycle'):
+            since = f'cycle:{get_head_cycle(network) - 2}'
+
+    if pipelined:
+        if source != 'blocks' or workers > 1:
+            raise ValueError('Pipelined mode parses blocks one level at a time, '
+                             'it cannot be combined with the indexer source or several workers')
+        return iter_unify_diff_pipelined(registry_address, indexer=indexer, since=since, raw=raw, network=network,
+                                         cache=cache, concurrency=concurrency)
+
+    updates = get_updates(registry_address, indexer=indexer, since=since, network=network, cache=cache,
+                          concurrency=concurrency, source=source)
     if not updates:
-        return []
+        return iter([])
 
     updates = list(sorted(updates, key=lambda x: x[0]))
     altered_addresses = list()
@@ -223,78 +770,216 @@ def get_unify_diff(registry_address, indexer='tzkt', since=None, raw=False) -> l
             registry_address=registry_address,
             bakers_addresses=list(set(altered_addresses)),
             raw=raw,
-            level=updates[0][0] - 1
+            level=updates[0][0] - 1,
+            network=network,
+            concurrency=concurrency,
+            indexer=indexer
         )
     else:
         snapshot = decode_snapshot(updates[0][1])
         updates = updates[1:]
 
-    with yaspin(text='Calculating json diffs...'):
-        log = list()
-        for level, update in updates:
-            for address, info in update.items():
-                if raw:
-                    info.pop('last_update')
-                    baker = decode_hex(info['bakerName'])
-                else:
-                    info = decode_info(info)
-                    baker = info['bakerName']
-
-                if address in snapshot:
-                    changes = diff(snapshot[address], info, syntax='symmetric')
-                    log.extend(map(lambda x: format_entry(x, level, baker),
-                                   list(iter_diff(changes))))
-                else:
-                    log.append(dict(
-                        level=level,
-                        baker=baker,
-                        kind='create',
-                        address=address
-                    ))
-
-                snapshot[address] = info
+    return diff_updates(updates, snapshot, raw=raw, workers=workers)
+
+
+def iter_unify_diff_pipelined(registry_address, indexer='tzkt', since=None, raw=False, network='mainnet',
+                              cache: DiffCache = None, concurrency=DEFAULT_CONCURRENCY) -> Iterator[dict]:
+    """
+    Same as iter_unify_diff, but the stages overlap: the baseline snapshot is fetched from the indexer in bulk
+    while blocks are being downloaded, and every level is diffed as soon as all lower levels have arrived.
+    Without a bulk snapshot all updates are awaited first, as the altered addresses are not known before.
+    """
+    update_operations = get_update_operations(registry_address, indexer=indexer, since=since)
+    if not update_operations:
+        return
+
+    first_level = min(update_operations)
+    bulk_snapshot_indexers = {
+        'tzkt': get_big_map_tzkt
+    }
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        baseline = executor.submit(bulk_snapshot_indexers[indexer], registry_address, level=first_level - 1) \
+            if since and indexer in bulk_snapshot_indexers else None
+        updates = iter_updates_pipelined(registry_address, update_operations, network=network, cache=cache,
+                                         concurrency=concurrency)
+
+        big_map = None
+        if not since:
+            _, update = next(updates)
+            snapshot = decode_snapshot(update)
+        elif baseline:
+            try:
+                big_map = baseline.result()
+            except (RpcError, requests.RequestException, ValueError, KeyError, IndexError):
+                pass
+
+        if big_map is not None:
+            snapshot = {address: format_info(info, raw=raw) for address, info in big_map.items()}
+        elif since:
+            updates = list(updates)
+            snapshot = get_snapshot(
+                registry_address=registry_address,
+                bakers_addresses=list({address for _, update in updates for address in update}),
+                raw=raw,
+                level=first_level - 1,
+                network=network,
+                concurrency=concurrency
+            )
+
+        yield from diff_updates(updates, snapshot, raw=raw)
+
+
+def get_unify_diff(registry_address, indexer='tzkt', since=None, raw=False, network='mainnet', cache: DiffCache = None,
+                   concurrency=DEFAULT_CONCURRENCY, source='blocks', workers=1, pipelined=False) -> list:
+    entries = iter_unify_diff(
+        registry_address=registry_address,
+        indexer=indexer,
+        since=since,
+        raw=raw,
+        network=network,
+        cache=cache,
+        concurrency=concurrency,
+        source=source,
+        workers=workers,
+        pipelined=pipelined)
+
+    with stage('Calculating diffs'):
+        log = list(entries)
 
     return list(reversed(log))
 
 
-def get_baker(registry_address, baker_address, raw=False, network='mainnet'):
-    data = get_snapshot(
+def get_bakers(registry_address, bakers_addresses: list, raw=False, network='mainnet',
+               concurrency=DEFAULT_CONCURRENCY, level=None, cache: DiffCache = None, indexer=None) -> dict:
+    """
+    Get configs of several bakers in one batched pass at a single level
+    :returns: {address: config} for the bakers found in the registry
+    """
+    history = RegistryHistory(cache, network, registry_address) if cache else None
+    if level is not None and history and level <= history.synced_level:
+        bakers = history.state_at(level).bakers
+        data = {address: format_info(bakers[address], raw=raw) for address in bakers_addresses if address in bakers}
+    else:
+        if level is None and len(bakers_addresses) > 1:
+            level = get_head_level(network)  # so that bulk and per-key lookups see the same state
+        data = get_snapshot(
+            registry_address=registry_address,
+            bakers_addresses=bakers_addresses,
+            raw=raw,
+            level=level,
+            network=network,
+            concurrency=concurrency,
+            indexer=indexer
+        )
+
+    return {address: value.to_dict() if isinstance(value, BakerInfo) else value
+            for address, value in data.items()}
+
+
+def get_baker(registry_address, baker_address, raw=False, network='mainnet', concurrency=DEFAULT_CONCURRENCY,
+              level=None, cache: DiffCache = None):
+    data = get_bakers(
         registry_address=registry_address,
         bakers_addresses=[baker_address],
         raw=raw,
-        network=network
+        network=network,
+        concurrency=concurrency,
+        level=level,
+        cache=cache
     )
-    if isinstance(data, dict) and set(data.keys()) == {baker_address}:
-        return data[baker_address]
-
-
-def upsert_baker(registry_address, baker_address, data, dry_run=False, network='mainnet'):
-    data = encode_info(data)
-    current_state = get_baker(
+    return data.get(baker_address)
+
+
+def multiple_transfers_cmdline(signer, calls: list, amounts: list) -> str:
+    """tezos-client command sending all contract calls from the signer in a single operation group"""
+    transfers = [dict(destination=call.address,
+                      amount=str(amount),
+                      entrypoint=call.parameters['entrypoint'],
+                      arg=micheline_to_michelson(call.parameters['value'], inline=True))
+                 for call, amount in zip(calls, amounts)]
+    return f"multiple transfers from {signer} using '{json.dumps(transfers)}'"
+
+
+def upsert_bakers(registry_address, configs: dict, dry_run=False, network='mainnet', signer=None,
+                  concurrency=DEFAULT_CONCURRENCY, indexer='tzkt') -> Tuple[List[str], list]:
+    """
+    Diff configs of many bakers against a single bulk snapshot and build one operation group per signer
+    :param configs: {baker_address: config in any representation}
+    :param signer: account sending all operations (default is each baker itself)
+    :returns: tezos-client command per signer, log of changes
+    """
+    configs = {address: encode_info(data) for address, data in configs.items()}
+    current_states = get_bakers(
         registry_address=registry_address,
-        baker_address=baker_address,
+        bakers_addresses=list(configs),
         network=network,
+        concurrency=concurrency,
+        indexer=indexer,
         raw=True
     )
 
-    if current_state:
-        changes = diff(current_state, data, syntax='symmetric')
-        log = list(map(format_entry, list(iter_diff(changes))))
-        fee = UPDATE_FEE
-    else:
-        log = [dict(kind='create', address=baker_address)]
-        fee = CREATE_FEE
+    log = list()
+    groups = dict()
+    for address, data in configs.items():
+        baker = address if len(configs) > 1 else ''
+        if current_states.get(address):
+            log.extend(format_entry(x, baker=baker) for x in iter_diff(current_states[address], data))
+            fee = UPDATE_FEE
+        else:
+            log.append(dict(kind='create', address=address))
+            fee = CREATE_FEE
+        groups.setdefault(signer or address, []).append((address, data, fee))
+
+    calls_by_signer = dict()
+
+    def make_calls(key, batch):
+        """Contract proxy and calls are built once per signer, both for the command line and the simulation"""
+        if key not in calls_by_signer:
+            registry = pytezos.using(shell=network.split(',')[0], key=key).contract(registry_address)
+            calls_by_signer[key] = [registry.set_data(delegate=address, **data).with_amount(fee)
+                                    for address, data, fee in batch]
+        return calls_by_signer[key]
+
+    def make_cmdline(key, batch):
+        calls = make_calls(key, batch)
+        if len(calls) == 1:
+            return calls[0].cmdline()
+        return multiple_transfers_cmdline(key, calls, [fee for _, _, fee in batch])
+
+    def simulate(key, batch):
+        calls = make_calls(key, batch)
+        if len(calls) == 1:
+            return calls[0].result() is not None
+        group = calls[0].as_transaction()
+        for call, (_, _, fee) in zip(calls[1:], batch[1:]):
+            group = group.transaction(destination=call.address, amount=fee, parameters=call.parameters)
+        return group.autofill() is not None
+
+    cmdlines = list()
+    for key, batch in groups.items():
+        # pytezos calls are recorded as a whole, keyed by the arguments
+        call_key = f'set_data {network} {registry_address} {key} ' \
+                   f'{json.dumps(batch, default=repr, sort_keys=True)}'
+
+        with stage('Generating command line'):
+            try:
+                cmdlines.append(get_transport().call(f'cmdline {call_key}', lambda: make_cmdline(key, batch)))
+            except Exception:
+                exit(-1)
 
-    with yaspin(text='Generating command line...'):
-        registry = pytezos.using(shell=network, key=baker_address).contract(registry_address)
-        try:
-            call = registry.set_data(delegate=baker_address, **data).with_amount(fee)
-            cmdline = call.cmdline()
-        except Exception:
-            exit(-1)
+        if dry_run:
+            with stage('Simulating operation'):
+                get_transport().call(f'simulate {call_key}', lambda: simulate(key, batch))
+
+    return cmdlines, log
 
-    if dry_run:
-        with yaspin(text='Simulating operation...'):
-            call.result()
 
-    return cmdline, log
+def upsert_baker(registry_address, baker_address, data, dry_run=False, network='mainnet'):
+    cmdlines, log = upsert_bakers(
+        registry_address=registry_address,
+        configs={baker_address: data},
+        dry_run=dry_run,
+        network=network
+    )
+    return cmdlines[0], log
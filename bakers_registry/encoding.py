@@ -18,40 +18,27 @@ def decode_hex(value):
     return value.decode()
 
 
-def decode_info(info):
-    data = info['data']
-    return {
-        'bakerName': decode_hex(data['bakerName']),
-        'openForDelegation': data['openForDelegation'],
-        'bakerOffchainRegistryUrl': decode_hex(data['bakerOffchainRegistryUrl']),
-        'fee': str(decode_split(data['split'])),
-        'bakerPaysFromAccounts': data['bakerPaysFromAccounts'],
-        'minDelegation': str(decode_mutez(data['minDelegation'])),
-        'subtractPayoutsLessThanMin': data['subtractPayoutsLessThanMin'],
-        'payoutDelay': data['payoutDelay'],
-        'payoutFrequency': data['payoutFrequency'],
-        'minPayout': str(decode_mutez(data['minPayout'])),
-        'bakerChargesTransactionFee': data['bakerChargesTransactionFee'],
-        'paymentConfig': {
-            'payForOwnBlocks': data['paymentConfigMask'] & 1 > 0,
-            'payForStolenBlocks': data['paymentConfigMask'] & 2048 > 0,
-            'compensateMissedBlocks': data['paymentConfigMask'] & 1024 == 0,
-            'payForEndorsements': data['paymentConfigMask'] & 2 > 0,
-            'compensateLowPriorityEndorsementLoss': data['paymentConfigMask'] & 8192 == 0,
-            'compensateMissedEndorsements': data['paymentConfigMask'] & 4096 == 0,
-            'payGainedFees': data['paymentConfigMask'] & 4 > 0,
-            'payForAccusationGains': data['paymentConfigMask'] & 8 > 0,
-            'subtractLostDepositsWhenAccused': data['paymentConfigMask'] & 16 > 0,
-            'subtractLostRewardsWhenAccused': data['paymentConfigMask'] & 32 > 0,
-            'subtractLostFeesWhenAccused': data['paymentConfigMask'] & 64 > 0,
-            'payForRevelation': data['paymentConfigMask'] & 128 > 0,
-            'subtractLostRewardsWhenMissRevelation': data['paymentConfigMask'] & 256 > 0,
-            'subtractLostFeesWhenMissRevelation': data['paymentConfigMask'] & 512 > 0
-        },
-        'overDelegationThreshold': str(decode_percent(data['overDelegationThreshold'])),
-        'subtractRewardsFromUninvitedDelegation': data['subtractRewardsFromUninvitedDelegation'],
-        'reporterAccount': info['reporterAccount']
-    }
+# (flag, bit, inverted): inverted flags are true when the bit is not set
+PAYMENT_CONFIG_BITS = (
+    ('payForOwnBlocks', 1, False),
+    ('payForStolenBlocks', 2048, False),
+    ('compensateMissedBlocks', 1024, True),
+    ('payForEndorsements', 2, False),
+    ('compensateLowPriorityEndorsementLoss', 8192, True),
+    ('compensateMissedEndorsements', 4096, True),
+    ('payGainedFees', 4, False),
+    ('payForAccusationGains', 8, False),
+    ('subtractLostDepositsWhenAccused', 16, False),
+    ('subtractLostRewardsWhenAccused', 32, False),
+    ('subtractLostFeesWhenAccused', 64, False),
+    ('payForRevelation', 128, False),
+    ('subtractLostRewardsWhenMissRevelation', 256, False),
+    ('subtractLostFeesWhenMissRevelation', 512, False),
+)
+
+
+def decode_config_mask(mask):
+    return {flag: bool(mask & bit) != inverted for flag, bit, inverted in PAYMENT_CONFIG_BITS}
 
 
 def try_hex_encode(data):
@@ -65,36 +52,12 @@ def encode_config_mask(data, default):
     if data.get('paymentConfigMask'):
         return int(data['paymentConfigMask'])
     if data.get('paymentConfig'):
-        mask = 0
         config = data['paymentConfig']
-        if config.get('payForOwnBlocks'):
-            mask |= 1
-        if config.get('payForStolenBlocks'):
-            mask |= 2048
-        if not config.get('compensateMissedBlocks'):
-            mask |= 1024
-        if config.get('payForEndorsements'):
-            mask |= 2
-        if not config.get('compensateLowPriorityEndorsementLoss'):
-            mask |= 8192
-        if not config.get('compensateMissedEndorsements'):
-            mask |= 4096
-        if config.get('payGainedFees'):
-            mask |= 4
-        if config.get('payForAccusationGains'):
-            mask |= 8
-        if config.get('subtractLostDepositsWhenAccused'):
-            mask |= 16
-        if config.get('subtractLostRewardsWhenAccused'):
-            mask |= 32
-        if config.get('subtractLostFeesWhenAccused'):
-            mask |= 64
-        if config.get('payForRevelation'):
-            mask |= 128
-        if config.get('subtractLostRewardsWhenMissRevelation'):
-            mask |= 256
-        if config.get('subtractLostFeesWhenMissRevelation'):
-            mask |= 512
+        mask = 0
+        for flag, bit, inverted in PAYMENT_CONFIG_BITS:
+            if bool(config.get(flag)) != inverted:
+                mask |= bit
+        return mask
     return default
 
 
@@ -131,25 +94,145 @@ def encode_split(data):
     return res
 
 
+def decode_fee(value):
+    return str(decode_split(value))
+
+
+def decode_tez(value):
+    return str(decode_mutez(value))
+
+
+def decode_threshold(value):
+    return str(decode_percent(value))
+
+
+def keep(value):
+    return value
+
+
+def encode_default(key, default, encoder=keep):
+    return lambda info: encoder(info.get(key, default))
+
+
+# (decoded key, raw key, decoder, encoder taking the whole config in any representation)
+INFO_FIELDS = (
+    ('bakerName', 'bakerName', decode_hex, encode_default('bakerName', '', try_hex_encode)),
+    ('openForDelegation', 'openForDelegation', keep, encode_default('openForDelegation', True)),
+    ('bakerOffchainRegistryUrl', 'bakerOffchainRegistryUrl', decode_hex,
+     encode_default('bakerOffchainRegistryUrl', '', try_hex_encode)),
+    ('fee', 'split', decode_fee, encode_split),
+    ('bakerPaysFromAccounts', 'bakerPaysFromAccounts', keep, encode_default('bakerPaysFromAccounts', [])),
+    ('minDelegation', 'minDelegation', decode_tez, encode_default('minDelegation', 0, encode_mutez)),
+    ('subtractPayoutsLessThanMin', 'subtractPayoutsLessThanMin', keep,
+     encode_default('subtractPayoutsLessThanMin', True)),
+    ('payoutDelay', 'payoutDelay', keep, encode_default('payoutDelay', 0)),
+    ('payoutFrequency', 'payoutFrequency', keep, encode_default('payoutFrequency', 1)),
+    ('minPayout', 'minPayout', decode_tez, encode_default('minPayout', 0, encode_mutez)),
+    ('bakerChargesTransactionFee', 'bakerChargesTransactionFee', keep,
+     encode_default('bakerChargesTransactionFee', False)),
+    ('paymentConfig', 'paymentConfigMask', decode_config_mask, lambda info: encode_config_mask(info, 16383)),
+    ('overDelegationThreshold', 'overDelegationThreshold', decode_threshold,
+     encode_default('overDelegationThreshold', 100, encode_percent)),
+    ('subtractRewardsFromUninvitedDelegation', 'subtractRewardsFromUninvitedDelegation', keep,
+     encode_default('subtractRewardsFromUninvitedDelegation', True)),
+)
+
+# BakerInfo keeps the payment config as a mask, all other fields are decoded
+RECORD_FIELDS = tuple(
+    (raw_key, raw_key, keep) if key == 'paymentConfig' else (key, raw_key, decoder)
+    for key, raw_key, decoder, _ in INFO_FIELDS
+)
+
+
+def decode_info(info):
+    data = info['data']
+    res = {key: decoder(data[raw_key]) for key, raw_key, decoder, _ in INFO_FIELDS}
+    res['reporterAccount'] = info['reporterAccount']
+    return res
+
+
 def encode_info(info):
     return {
-        'data': {'bakerName': try_hex_encode(info.get('bakerName', '')),
-                 'openForDelegation': info.get('openForDelegation', True),
-                 'bakerOffchainRegistryUrl': try_hex_encode(info.get('bakerOffchainRegistryUrl', '')),
-                 'split': encode_split(info),
-                 'bakerPaysFromAccounts': info.get('bakerPaysFromAccounts', []),
-                 'minDelegation': encode_mutez(info.get('minDelegation', 0)),
-                 'subtractPayoutsLessThanMin': info.get('subtractPayoutsLessThanMin', True),
-                 'payoutDelay': info.get('payoutDelay', 0),
-                 'payoutFrequency': info.get('payoutFrequency', 1),
-                 'minPayout': encode_mutez(info.get('minPayout', 0)),
-                 'bakerChargesTransactionFee': info.get('bakerChargesTransactionFee', False),
-                 'paymentConfigMask': encode_config_mask(info, 16383),
-                 'overDelegationThreshold': encode_percent(info.get('overDelegationThreshold', 100)),
-                 'subtractRewardsFromUninvitedDelegation': info.get('subtractRewardsFromUninvitedDelegation', True)},
-        'reporterAccount': info['reporterAccount']
+        'data': {raw_key: encoder(info) for _, raw_key, _, encoder in INFO_FIELDS},
+        'reporterAccount': info.get('reporterAccount')
+    }
+
+
+class BakerInfo:
+    """Compact decoded baker record, payment config is kept as a bit mask"""
+    __slots__ = tuple(key for key, _, _ in RECORD_FIELDS) + ('reporterAccount',)
+
+    def __init__(self, **fields):
+        for key in self.__slots__:
+            setattr(self, key, fields.get(key))
+
+    @classmethod
+    def from_raw(cls, info):
+        data = info['data']
+        record = cls.__new__(cls)
+        for key, raw_key, decoder in RECORD_FIELDS:
+            setattr(record, key, decoder(data[raw_key]))
+        record.reporterAccount = info['reporterAccount']
+        return record
+
+    def to_dict(self) -> dict:
+        """Same representation as decode_info"""
+        res = {}
+        for key, raw_key, _, _ in INFO_FIELDS:
+            if key == 'paymentConfig':
+                res[key] = decode_config_mask(self.paymentConfigMask)
+            elif key == 'bakerPaysFromAccounts':
+                res[key] = list(self.bakerPaysFromAccounts)
+            else:
+                res[key] = getattr(self, key)
+        res['reporterAccount'] = self.reporterAccount
+        return res
+
+    def __eq__(self, other):
+        return isinstance(other, BakerInfo) \
+            and all(getattr(self, key) == getattr(other, key) for key in self.__slots__)
+
+    def __repr__(self):
+        return f'BakerInfo({self.bakerName!r})'
+
+
+def freeze_info(info) -> tuple:
+    data = info['data']
+    return tuple(tuple(data[raw_key]) if isinstance(data[raw_key], list) else data[raw_key]
+                 for _, raw_key, _ in RECORD_FIELDS) + (info['reporterAccount'],)
+
+
+def decode_record(info, memo: dict = None) -> BakerInfo:
+    """Decode raw big map value into BakerInfo, identical payloads are decoded once if memo is passed"""
+    if memo is None:
+        return BakerInfo.from_raw(info)
+    key = freeze_info(info)
+    record = memo.get(key)
+    if record is None:
+        record = memo[key] = BakerInfo.from_raw(info)
+    return record
+
+
+def parse_indexer_info(value):
+    """Convert big map value as returned by indexers (bytes as hex, numbers as strings) to the raw format"""
+    data = value['data']
+    return {
+        'data': {
+            **data,
+            'bakerName': bytes.fromhex(data['bakerName']),
+            'bakerOffchainRegistryUrl': bytes.fromhex(data['bakerOffchainRegistryUrl']),
+            **{key: int(data[key]) for key in ['split', 'minDelegation', 'payoutDelay', 'payoutFrequency',
+                                               'minPayout', 'paymentConfigMask', 'overDelegationThreshold']}
+        },
+        'reporterAccount': value.get('reporterAccount'),
+        'last_update': value.get('last_update')
     }
 
 
-def decode_snapshot(snapshot: dict):
-    return dict(map(lambda x: (x[0], decode_info(x[1])), snapshot.items()))
+def decode_snapshot(snapshot: dict, memo: dict = None) -> dict:
+    """
+    Decode all records of a big map snapshot in one pass, records with identical payloads are shared.
+    Removed keys (None values) are skipped.
+    """
+    memo = dict() if memo is None else memo
+    return {address: decode_record(info, memo) for address, info in snapshot.items() if info is not None}
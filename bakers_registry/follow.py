@@ -0,0 +1,98 @@
+import asyncio
+import os
+import pickle
+import time
+from typing import Iterator, List, Optional, Tuple
+
+from bakers_registry.cache import DiffCache
+from bakers_registry.core import get_updates, get_snapshot, get_head_level, diff_updates, fetch_big_map_diff, \
+    parse_since, load_registry
+from bakers_registry.rpc import RpcEngine, DEFAULT_CONCURRENCY
+
+POLL_INTERVAL = 30
+INDEXER_LAG = 5  # levels the indexer may be behind the node
+
+
+def load_checkpoint(path, raw=False) -> Optional[Tuple[int, dict]]:
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        checkpoint = pickle.load(f)
+    if checkpoint['raw'] != raw:
+        return None
+    return checkpoint['level'], checkpoint['snapshot']
+
+
+def save_checkpoint(path, level, snapshot, raw=False):
+    if not path:
+        return
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(dict(level=level, snapshot=snapshot, raw=raw), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def apply_updates(registry_address, updates: List[Tuple[int, dict]], snapshot: dict, raw=False,
+                  indexer='tzkt', network='mainnet', concurrency=DEFAULT_CONCURRENCY) -> Iterator[dict]:
+    """Diff updates against the in-memory snapshot, fetching bakers seen for the first time"""
+    if not updates:
+        return
+
+    updates = list(sorted(updates, key=lambda x: x[0]))
+    unknown_addresses = {address for _, update in updates for address in update if address not in snapshot}
+    if unknown_addresses:
+        snapshot.update(get_snapshot(
+            registry_address=registry_address,
+            bakers_addresses=list(unknown_addresses),
+            raw=raw,
+            level=updates[0][0] - 1,
+            network=network,
+            concurrency=concurrency,
+            indexer=indexer))
+
+    yield from diff_updates(updates, snapshot, raw=raw)
+
+
+def follow_unify_diff(registry_address, indexer='tzkt', since=None, raw=False, network='mainnet',
+                      cache: DiffCache = None, concurrency=DEFAULT_CONCURRENCY,
+                      checkpoint_file=None, poll_interval=POLL_INTERVAL, source='blocks') -> Iterator[dict]:
+    """
+    Yield log entries as new blocks arrive, never returns.
+    Catches up from the checkpoint (or `since`, or head) using the indexer, then polls the node for new heads
+    and parses registry operations of the new blocks only.
+    """
+    checkpoint = load_checkpoint(checkpoint_file, raw=raw)
+    if checkpoint:
+        level, snapshot = checkpoint
+    else:
+        level, snapshot = None, dict()
+
+    head_level = get_head_level(network)
+    if level is None:
+        level = head_level if since is None else parse_since(since)
+
+    if level < head_level - INDEXER_LAG:
+        updates = get_updates(registry_address, indexer=indexer, since=level, network=network,
+                              cache=cache, concurrency=concurrency, source=source)
+        yield from apply_updates(registry_address, updates, snapshot, raw=raw,
+                                 indexer=indexer, network=network, concurrency=concurrency)
+        # blocks possibly missing in the indexer are parsed again, except those up to the last level it returned:
+        # indexers go block by block, and re-applying an older value would log a bogus reversal
+        level = max([head_level - INDEXER_LAG] + [update_level for update_level, _ in updates])
+        save_checkpoint(checkpoint_file, level, snapshot, raw=raw)
+
+    async def fetch_updates(levels):
+        async with RpcEngine(network, concurrency=concurrency) as engine:
+            registry = await load_registry(engine, registry_address)
+            return await engine.map(
+                lambda x: fetch_big_map_diff(engine, registry, x, registry_address=registry_address), levels)
+
+    while True:
+        head_level = get_head_level(network)
+        if head_level > level:
+            updates = asyncio.run(fetch_updates(range(level + 1, head_level + 1)))
+            yield from apply_updates(registry_address, [x for x in updates if x[1]], snapshot, raw=raw,
+                                     indexer=indexer, network=network, concurrency=concurrency)
+            level = head_level
+            save_checkpoint(checkpoint_file, level, snapshot, raw=raw)
+        time.sleep(poll_interval)
@@ -0,0 +1,67 @@
+from typing import Tuple
+
+from bakers_registry.cache import DiffCache
+from bakers_registry.encoding import decode_snapshot
+from bakers_registry.query import RegistryIndex
+from bakers_registry.state import RegistryState
+
+CHECKPOINT_INTERVAL = 10000
+
+
+class RegistryHistory:
+    """Event-sourced history of the registry big map with registry states materialized every K levels"""
+
+    def __init__(self, cache: DiffCache, network, registry_address, checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.cache = cache
+        self.network = network
+        self.registry_address = registry_address
+        self.checkpoint_interval = checkpoint_interval
+
+    @property
+    def synced_level(self) -> int:
+        return self.cache.get_synced_level(self.network, self.registry_address)
+
+    def _nearest_checkpoint(self, level) -> Tuple[int, RegistryState]:
+        checkpoint = self.cache.get_checkpoint(self.network, self.registry_address, level)
+        return checkpoint if checkpoint else (0, RegistryState())
+
+    def mark_synced(self, level: int):
+        """Declare that the cache holds every update up to the level and materialize missing checkpoints"""
+        synced_level = self.synced_level
+        if level <= synced_level:
+            return
+
+        checkpoint_level, state = self._nearest_checkpoint(synced_level)
+        next_checkpoint = None
+        for update_level, update in self.cache.get_range(self.network, self.registry_address,
+                                                         checkpoint_level, level):
+            if next_checkpoint is None:
+                next_checkpoint = (max(checkpoint_level, update_level - 1) // self.checkpoint_interval + 1) \
+                    * self.checkpoint_interval
+            while update_level > next_checkpoint:
+                self.cache.put_checkpoint(self.network, self.registry_address, next_checkpoint, state)
+                next_checkpoint += self.checkpoint_interval
+            state.apply(update_level, update)
+
+        while next_checkpoint is not None and next_checkpoint <= level:
+            self.cache.put_checkpoint(self.network, self.registry_address, next_checkpoint, state)
+            next_checkpoint += self.checkpoint_interval
+
+        self.cache.set_synced_level(self.network, self.registry_address, level)
+
+    def state_at(self, level: int) -> RegistryState:
+        """Load the nearest checkpoint and replay stored diffs up to the level, no network involved"""
+        assert level <= self.synced_level, f'History is synced up to {self.synced_level} only'
+        checkpoint_level, state = self._nearest_checkpoint(level)
+        for update_level, update in self.cache.get_range(self.network, self.registry_address,
+                                                         checkpoint_level, level):
+            state.apply(update_level, update)
+        return state
+
+    def index_at(self, level: int) -> RegistryIndex:
+        """Field indexes over the registry state at the level, built once and stored next to the checkpoints"""
+        index = self.cache.get_index(self.network, self.registry_address, level)
+        if index is None:
+            index = RegistryIndex(decode_snapshot(self.state_at(level).bakers))
+            self.cache.put_index(self.network, self.registry_address, level, index)
+        return index
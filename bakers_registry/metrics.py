@@ -0,0 +1,105 @@
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlsplit
+from yaspin import yaspin
+
+PERCENTILES = (50, 95, 99)
+# path segments that vary between requests to the same endpoint: levels, hashes, addresses
+VARIABLE_SEGMENT = re.compile(r'^(\d{2,}|head|[a-zA-Z0-9]{36,})$')
+
+
+def endpoint_name(url) -> str:
+    """Collapse variable path segments, e.g. https://node/chains/main/blocks/{}/operations/3"""
+    parts = urlsplit(url)
+    path = '/'.join('{}' if VARIABLE_SEGMENT.match(segment) else segment for segment in parts.path.split('/'))
+    return f'{parts.netloc}{path}'
+
+
+def percentile(values: list, p) -> float:
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, (len(values) * p + 99) // 100 - 1))]
+
+
+class Metrics:
+    """Wall time per stage and per-endpoint request statistics collected during a single run"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = defaultdict(float)
+        self.latencies = defaultdict(list)
+        self.bytes = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.retries = defaultdict(int)
+
+    def add_stage(self, name, seconds):
+        with self.lock:
+            self.stages[name] += seconds
+
+    def add_request(self, url, status, latency, size):
+        endpoint = endpoint_name(url)
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            self.bytes[endpoint] += size
+            if status != 200:
+                self.errors[endpoint] += 1
+
+    def add_retry(self, url):
+        with self.lock:
+            self.retries[endpoint_name(url)] += 1
+
+    def to_dict(self) -> dict:
+        endpoints = dict()
+        for endpoint in sorted(set(self.latencies) | set(self.retries)):
+            latencies = list(sorted(self.latencies[endpoint]))
+            endpoints[endpoint] = dict(
+                requests=len(latencies),
+                bytes=self.bytes[endpoint],
+                errors=self.errors[endpoint],
+                retries=self.retries[endpoint],
+                **{f'p{p}': percentile(latencies, p) for p in PERCENTILES})
+        return dict(stages=dict(self.stages), endpoints=endpoints)
+
+    def print_summary(self, file=sys.stderr):
+        data = self.to_dict()
+        print(f'{"stage":<48} {"seconds":>9}', file=file)
+        for name, seconds in data['stages'].items():
+            print(f'{name:<48} {seconds:>9.3f}', file=file)
+        print(file=file)
+        print(f'{"endpoint":<72} {"requests":>8} {"KiB":>9} {"errors":>6} {"retries":>7} '
+              + ' '.join(f'{f"p{p}":>7}' for p in PERCENTILES), file=file)
+        for endpoint, stats in data['endpoints'].items():
+            print(f'{endpoint[-72:]:<72} {stats["requests"]:>8} {stats["bytes"] / 1024:>9.1f} '
+                  f'{stats["errors"]:>6} {stats["retries"]:>7} '
+                  + ' '.join(f'{stats[f"p{p}"]:>7.3f}' for p in PERCENTILES), file=file)
+
+
+metrics = Metrics()
+spinners_enabled = True
+
+
+def get_metrics() -> Metrics:
+    return metrics
+
+
+def set_spinners(enabled):
+    """Spinners are drawn on stdout, turn them off when stdout carries the data"""
+    global spinners_enabled
+    spinners_enabled = enabled
+
+
+@contextmanager
+def stage(name, text=None):
+    """Show a spinner while the stage is running (only if stdout is a terminal) and account its wall time"""
+    started_at = time.perf_counter()
+    try:
+        spin = spinners_enabled and hasattr(sys.stdout, 'isatty') and sys.stdout.isatty()
+        with yaspin(text=text or f'{name}...') if spin else nullcontext():
+            yield
+    finally:
+        metrics.add_stage(name, time.perf_counter() - started_at)
@@ -0,0 +1,125 @@
+import re
+from bisect import bisect_left, bisect_right
+from decimal import Decimal, InvalidOperation
+from typing import Dict, List, Tuple
+
+from bakers_registry.encoding import BakerInfo, PAYMENT_CONFIG_BITS
+
+NUMERIC_FIELDS = ('fee', 'minDelegation', 'minPayout', 'overDelegationThreshold', 'payoutDelay', 'payoutFrequency')
+BOOLEAN_FIELDS = ('openForDelegation', 'subtractPayoutsLessThanMin', 'bakerChargesTransactionFee',
+                  'subtractRewardsFromUninvitedDelegation')
+FLAG_FIELDS = tuple(flag for flag, _, _ in PAYMENT_CONFIG_BITS)
+CONDITION = re.compile(r'^(\w+)\s*(<=|>=|==|!=|<|>|=)\s*(.+)$')
+
+
+def parse_condition(condition: str) -> Tuple[str, str, object]:
+    """
+    Parse filter expression: "fee<=0.1", "minDelegation>100", "openForDelegation", "!payForStolenBlocks"
+    :returns: (field, operator, value)
+    """
+    condition = condition.strip()
+    match = CONDITION.match(condition)
+    if match:
+        field, op, value = match.groups()
+        op = '==' if op == '=' else op
+    elif condition.startswith('!'):
+        field, op, value = condition[1:], '==', 'false'
+    else:
+        field, op, value = condition, '==', 'true'
+
+    if field in NUMERIC_FIELDS:
+        try:
+            return field, op, Decimal(value)
+        except InvalidOperation:
+            raise ValueError(f'Invalid number {value}')
+    if field in BOOLEAN_FIELDS or field in FLAG_FIELDS:
+        if op not in ['==', '!='] or value.lower() not in ['true', 'false']:
+            raise ValueError(f'Boolean field {field} can only be compared with true or false')
+        return field, '==', (value.lower() == 'true') == (op == '==')
+    raise ValueError(f'Unknown field {field}')
+
+
+def to_bitmap(positions) -> int:
+    bitmap = 0
+    for position in positions:
+        bitmap |= 1 << position
+    return bitmap
+
+
+def iter_positions(bitmap: int):
+    while bitmap:
+        lowest = bitmap & -bitmap
+        yield lowest.bit_length() - 1
+        bitmap ^= lowest
+
+
+class RegistryIndex:
+    """
+    Secondary indexes over decoded baker records.
+    Numeric fields are kept as sorted (value, position) lists, boolean fields and payment config flags
+    as bitmaps where bit N is set if the N-th baker has the flag on.
+    """
+
+    def __init__(self, records: Dict[str, BakerInfo]):
+        self.addresses = list(sorted(records))
+        self.records = [records[address] for address in self.addresses]
+        self.all = (1 << len(self.records)) - 1
+
+        self.sorted = dict()
+        for field in NUMERIC_FIELDS:
+            pairs = sorted((Decimal(getattr(record, field)), i) for i, record in enumerate(self.records))
+            self.sorted[field] = ([value for value, _ in pairs], [i for _, i in pairs])
+
+        self.bitmaps = {field: to_bitmap(i for i, record in enumerate(self.records) if getattr(record, field))
+                        for field in BOOLEAN_FIELDS}
+        for flag, bit, inverted in PAYMENT_CONFIG_BITS:
+            self.bitmaps[flag] = to_bitmap(i for i, record in enumerate(self.records)
+                                           if bool(record.paymentConfigMask & bit) != inverted)
+
+    def select_range(self, field, op, value) -> int:
+        values, positions = self.sorted[field]
+        if op == '<':
+            return to_bitmap(positions[:bisect_left(values, value)])
+        if op == '<=':
+            return to_bitmap(positions[:bisect_right(values, value)])
+        if op == '>':
+            return to_bitmap(positions[bisect_right(values, value):])
+        if op == '>=':
+            return to_bitmap(positions[bisect_left(values, value):])
+        matching = to_bitmap(positions[bisect_left(values, value):bisect_right(values, value)])
+        return matching if op == '==' else self.all & ~matching
+
+    def select(self, conditions: List[str]) -> int:
+        """Bitmap of bakers matching all the conditions"""
+        bitmap = self.all
+        for condition in conditions:
+            field, op, value = parse_condition(condition)
+            if field in self.sorted:
+                bitmap &= self.select_range(field, op, value)
+            else:
+                bitmap &= self.bitmaps[field] if value else self.all & ~self.bitmaps[field]
+        return bitmap
+
+    def query(self, conditions: List[str], sort=None, limit=None) -> List[Tuple[str, BakerInfo]]:
+        """
+        Find bakers matching all the conditions
+        :param sort: numeric field to order by, prefixed with "-" for descending order (default is by address)
+        :param limit: max number of results
+        """
+        bitmap = self.select(conditions)
+        if sort:
+            field = sort.lstrip('-')
+            if field not in self.sorted:
+                raise ValueError(f'Cannot sort by {field}, choose one of {", ".join(NUMERIC_FIELDS)}')
+            _, positions = self.sorted[field]
+            ordered = reversed(positions) if sort.startswith('-') else positions
+            positions = (i for i in ordered if bitmap >> i & 1)
+        else:
+            positions = iter_positions(bitmap)
+
+        res = list()
+        for i in positions:
+            if limit is not None and len(res) >= limit:
+                break
+            res.append((self.addresses[i], self.records[i]))
+        return res
@@ -0,0 +1,196 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Iterable, List
+
+NODES = {
+    'mainnet': ['https://mainnet-tezos.giganode.io', 'https://rpc.tzbeta.net', 'https://mainnet.smartpy.io'],
+    'carthagenet': ['https://testnet-tezos.giganode.io', 'https://carthagenet.smartpy.io'],
+}
+DEFAULT_CONCURRENCY = 50
+KEEPALIVE_TIMEOUT = 30
+REQUEST_TIMEOUT = 60
+MAX_ATTEMPTS = 3  # each on a different node if possible
+FAILURE_COOLDOWN = 30  # seconds a node is skipped after a failed request
+EWMA_ALPHA = 0.2
+HEDGE_PERCENTILE = 95  # straggling block fetches are duplicated on another node after this latency
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 500
+
+
+def node_urls(network) -> List[str]:
+    """Known public nodes for the network name, or comma-separated RPC urls"""
+    return [url.rstrip('/') for url in NODES.get(network) or network.split(',')]
+
+
+class NodeStats:
+    """Latency and health of a single RPC node"""
+
+    def __init__(self, url):
+        self.url = url
+        self.latency = 0.0  # exponentially weighted moving average, untried nodes go first
+        self.inflight = 0
+        self.down_until = 0.0
+
+    def score(self) -> float:
+        return self.latency * (self.inflight + 1)
+
+    def is_healthy(self, now) -> bool:
+        return self.down_until <= now
+
+    def on_success(self, latency):
+        self.latency = latency if not self.latency else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency
+
+    def on_failure(self):
+        self.down_until = time.monotonic() + FAILURE_COOLDOWN
+
+
+class RpcEngine:
+    """
+    Asynchronous Tezos RPC client sharing a single pool of keep-alive connections.
+    Requests are routed to the fastest healthy node of the pool, failed ones are retried on other nodes
+    and straggling block fetches are hedged with a duplicate request.
+    """
+
+    def __init__(self, network='mainnet', concurrency=DEFAULT_CONCURRENCY):
+        """
+        :param network: network name, RPC node url or several comma-separated urls
+        :param concurrency: max number of requests in flight
+        """
+        self.nodes = [NodeStats(url) for url in node_urls(network)]
+        self.concurrency = concurrency
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.session = None
+        self.semaphore = None
+
+    async def __aenter__(self):
+        import aiohttp  # loaded on first use, commands that do not talk to the node start faster
+        connector = aiohttp.TCPConnector(limit=self.concurrency * len(self.nodes),
+                                         limit_per_host=self.concurrency,
+                                         keepalive_timeout=KEEPALIVE_TIMEOUT)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+
+    def pick_node(self, exclude=()) -> NodeStats:
+        now = time.monotonic()
+        candidates = [node for node in self.nodes if node not in exclude] or self.nodes
+        healthy = [node for node in candidates if node.is_healthy(now)] or candidates
+        return min(healthy, key=lambda node: node.score())
+
+    def hedge_delay(self):
+        if len(self.nodes) < 2 or len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, len(latencies) * HEDGE_PERCENTILE // 100)]
+
+    async def attempt(self, node: NodeStats, method, path, data=None, allow_not_found=False):
+        from bakers_registry.transport import get_transport
+        from bakers_registry.scheduler import MAX_RETRIES
+        node.inflight += 1
+        started_at = time.perf_counter()
+        try:
+            # cassette entries are keyed by path, so that replay does not depend on routing
+            res = await get_transport().request(self.session, method, f'{node.url}/{path}', data=data,
+                                                allow_not_found=allow_not_found, key_url=path,
+                                                # with other nodes around it is faster to fail over than to wait
+                                                retries=0 if len(self.nodes) > 1 else MAX_RETRIES)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            node.on_failure()
+            raise
+        finally:
+            node.inflight -= 1
+
+        latency = time.perf_counter() - started_at
+        node.on_success(latency)
+        self.latencies.append(latency)
+        return res
+
+    async def hedged_attempt(self, node: NodeStats, tried: list, method, path, data=None, allow_not_found=False):
+        """Send a duplicate request to another node if the first one is slower than usual, first success wins"""
+        primary = asyncio.ensure_future(self.attempt(node, method, path, data, allow_not_found))
+        delay = self.hedge_delay()
+        if delay is None:
+            return await primary
+
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        backup_node = self.pick_node(exclude=tried)
+        if done or backup_node in tried:
+            return await primary
+
+        tried.append(backup_node)
+        pending = {primary, asyncio.ensure_future(self.attempt(backup_node, method, path, data, allow_not_found))}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    async def request(self, method, path, data=None, allow_not_found=False, hedge=False):
+        from bakers_registry.metrics import get_metrics
+        async with self.semaphore:
+            tried = list()
+            for attempt in range(MAX_ATTEMPTS):
+                node = self.pick_node(exclude=tried)
+                tried.append(node)
+                try:
+                    if hedge:
+                        return await self.hedged_attempt(node, tried, method, path, data, allow_not_found)
+                    return await self.attempt(node, method, path, data, allow_not_found)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    if attempt == MAX_ATTEMPTS - 1:
+                        raise
+                    get_metrics().add_retry(f'{node.url}/{path}')
+
+    async def map(self, fn: Callable[..., Awaitable], items: Iterable) -> List:
+        """
+        Apply coroutine function to every item, keeping at most `concurrency` calls scheduled.
+        Results are returned in the order of items.
+        """
+        items = list(items)
+        results = [None] * len(items)
+        pending = iter(enumerate(items))
+
+        async def worker():
+            for i, item in pending:
+                results[i] = await fn(item)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(items)))))
+        return results
+
+    async def head_header(self) -> dict:
+        return await self.request('GET', 'chains/main/blocks/head/header')
+
+    async def head_metadata(self) -> dict:
+        return await self.request('GET', 'chains/main/blocks/head/metadata')
+
+    async def manager_operations(self, level) -> list:
+        return await self.request('GET', f'chains/main/blocks/{level}/operations/3', hedge=True)
+
+    async def manager_operation(self, level, index) -> dict:
+        return await self.request('GET', f'chains/main/blocks/{level}/operations/3/{index}', hedge=True)
+
+    async def operation_hashes(self, level) -> list:
+        """Hashes of manager operations in the block, in the same order as operations"""
+        return await self.request('GET', f'chains/main/blocks/{level}/operation_hashes/3', hedge=True)
+
+    async def big_map_get(self, contract_address, query: dict, block_id='head'):
+        """Returns raw Micheline value or None if the key is not found"""
+        path = f'chains/main/blocks/{block_id}/context/contracts/{contract_address}/big_map_get'
+        return await self.request('POST', path, data=query, allow_not_found=True)
+
+    async def contract_script(self, contract_address) -> dict:
+        return await self.request('GET', f'chains/main/blocks/head/context/contracts/{contract_address}/script')
@@ -0,0 +1,136 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+from urllib.parse import urlsplit
+
+INITIAL_WINDOW = 4  # requests in flight per host before anything is known about it
+MIN_WINDOW = 1
+MAX_WINDOW = 64
+DECREASE_FACTOR = 0.5
+LATENCY_FACTOR = 4  # latency this many times above the best one seen is treated as congestion
+LATENCY_FLOOR = 1.0  # seconds, faster responses are never treated as congestion
+POLL_INTERVAL = 0.01
+DEFAULT_RATE = (200, 200)  # requests per second, burst
+HOST_RATES = {
+    'api.tzkt.io': (10, 20),
+    'api.tzstats.com': (5, 10),
+}
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def backoff_delay(attempt) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def parse_retry_after(value) -> Optional[float]:
+    """Retry-After header value, either seconds or HTTP date, as seconds from now"""
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostLimiter:
+    """
+    Per-host admission control: a token bucket caps the request rate, an AIMD window caps requests in flight.
+    The window grows by one per success until the first congestion signal (slow start), then by one per window;
+    it is halved on throttling, server errors and latency spikes, at most once per round trip.
+    """
+
+    def __init__(self, rate, burst):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.refilled_at = time.monotonic()
+        self.window = INITIAL_WINDOW
+        self.slow_start = True
+        self.inflight = 0
+        self.blocked_until = 0.0
+        self.best_latency = None
+        self.decreased_at = 0.0
+
+    def try_acquire(self) -> float:
+        """Take a slot if possible, otherwise return the number of seconds to wait before trying again"""
+        with self.lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.inflight >= int(self.window):
+                return POLL_INTERVAL
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+            self.refilled_at = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+            self.inflight += 1
+            return 0
+
+    def acquire(self):
+        delay = self.try_acquire()
+        while delay:
+            time.sleep(delay)
+            delay = self.try_acquire()
+
+    async def acquire_async(self):
+        delay = self.try_acquire()
+        while delay:
+            await asyncio.sleep(delay)
+            delay = self.try_acquire()
+
+    def abandon(self):
+        """Free the slot of a cancelled request, it says nothing about the host"""
+        with self.lock:
+            self.inflight -= 1
+
+    def release(self, status=None, latency=None, retry_after=None):
+        """
+        :param status: HTTP status, None if the request failed without a response
+        :param latency: seconds the request took
+        :param retry_after: seconds the host asked to wait before the next request
+        """
+        with self.lock:
+            self.inflight -= 1
+            now = time.monotonic()
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+
+            congested = status is None or status in RETRY_STATUSES
+            if status == 200 and latency is not None:
+                self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+                congested = latency > max(LATENCY_FLOOR, self.best_latency * LATENCY_FACTOR)
+
+            if congested:
+                self.slow_start = False
+                if now - self.decreased_at > (self.best_latency or 0):
+                    self.window = max(MIN_WINDOW, self.window * DECREASE_FACTOR)
+                    self.decreased_at = now
+            elif status == 200:
+                self.window = min(MAX_WINDOW, self.window + (1 if self.slow_start else 1 / self.window))
+
+
+class Scheduler:
+    """Limiters shared by all requests to the same host"""
+
+    def __init__(self, host_rates: dict = None):
+        self.host_rates = host_rates or HOST_RATES
+        self.hosts = dict()
+        self.lock = threading.Lock()
+
+    def host(self, url) -> HostLimiter:
+        netloc = urlsplit(url).netloc
+        with self.lock:
+            if netloc not in self.hosts:
+                self.hosts[netloc] = HostLimiter(*self.host_rates.get(netloc, DEFAULT_RATE))
+            return self.hosts[netloc]
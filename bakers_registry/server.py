@@ -0,0 +1,151 @@
+import sys
+import threading
+import time
+import traceback
+from bisect import bisect_right
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import simplejson as json
+
+from bakers_registry.cache import DiffCache
+from bakers_registry.core import get_updates, diff_updates, parse_since
+from bakers_registry.rpc import DEFAULT_CONCURRENCY
+
+SYNC_INTERVAL = 60
+
+
+class RegistryView:
+    """Immutable snapshot of the service state at a synced level"""
+    __slots__ = ('level', 'bakers', 'bakers_json', 'entries', 'entry_levels')
+
+    def __init__(self, level=0, bakers=None, bakers_json=b'{}', entries=(), entry_levels=()):
+        self.level = level
+        self.bakers = bakers or dict()
+        self.bakers_json = bakers_json
+        self.entries = entries
+        self.entry_levels = entry_levels
+
+    @property
+    def etag(self):
+        return f'"{self.level}"'
+
+    def log_since(self, since=None) -> list:
+        if since is None:
+            return list(self.entries)
+        return list(self.entries[bisect_right(self.entry_levels, parse_since(since)):])
+
+
+class RegistryService:
+    """
+    Decoded registry state and change log kept in memory, synced incrementally in a background thread.
+    Readers always see a consistent view: every sync builds new containers and swaps them in at once.
+    """
+
+    def __init__(self, registry_address, indexer='tzkt', network='mainnet', no_cache=False,
+                 concurrency=DEFAULT_CONCURRENCY, sync_interval=SYNC_INTERVAL, source='blocks'):
+        self.registry_address = registry_address
+        self.indexer = indexer
+        self.network = network
+        self.no_cache = no_cache
+        self.concurrency = concurrency
+        self.sync_interval = sync_interval
+        self.source = source
+        self.ready = threading.Event()
+        self.records = dict()  # owned by the sync thread
+        self.view = RegistryView()
+
+    def sync(self, cache: DiffCache = None):
+        """Fetch updates since the last synced level and publish the new view"""
+        view = self.view
+        updates = get_updates(self.registry_address, indexer=self.indexer, since=view.level or None,
+                              network=self.network, cache=cache, concurrency=self.concurrency, source=self.source)
+        if not updates:
+            return
+
+        updates = list(sorted(updates, key=lambda x: x[0]))
+        new_entries = list(diff_updates(updates, self.records))
+        changed = {address for _, update in updates for address in update}
+
+        bakers = dict(view.bakers)
+        for address in changed:
+            if address in self.records:
+                bakers[address] = self.records[address].to_dict()
+            else:
+                bakers.pop(address, None)
+        self.view = RegistryView(
+            level=updates[-1][0],
+            bakers=bakers,
+            bakers_json=json.dumps(bakers).encode(),
+            entries=view.entries + tuple(new_entries),
+            entry_levels=view.entry_levels + tuple(entry['level'] for entry in new_entries))
+
+    def run(self):
+        cache = None if self.no_cache else DiffCache()
+        while True:
+            try:
+                self.sync(cache)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+            self.ready.set()
+            time.sleep(self.sync_interval)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        self.ready.wait()
+
+
+def make_handler(service: RegistryService):
+    class RegistryRequestHandler(BaseHTTPRequestHandler):
+        def send_json(self, body: bytes, etag, status=200):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            if etag:
+                self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            path = url.path.rstrip('/')
+            view = service.view
+            etag = view.etag
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+
+            if path == '/bakers':
+                self.send_json(view.bakers_json, etag)
+            elif path.startswith('/bakers/'):
+                data = view.bakers.get(path[len('/bakers/'):])
+                if data is None:
+                    self.send_json(json.dumps(dict(error='Not found')).encode(), None, status=404)
+                else:
+                    self.send_json(json.dumps(data).encode(), etag)
+            elif path == '/log':
+                since = parse_qs(url.query).get('since', [None])[0]
+                try:
+                    entries = view.log_since(int(since) if since and since.isdigit() else since)
+                except (AssertionError, ValueError):
+                    self.send_json(json.dumps(dict(error=f'Invalid since: {since}')).encode(), None, status=400)
+                else:
+                    self.send_json(json.dumps(entries).encode(), etag)
+            else:
+                self.send_json(json.dumps(dict(error='Not found')).encode(), None, status=404)
+
+    return RegistryRequestHandler
+
+
+def serve(service: RegistryService, host='127.0.0.1', port=8080):
+    """Sync the registry, then serve it until interrupted"""
+    service.start()
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f'Serving registry synced at level {service.view.level} on http://{host}:{port}', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,33 @@
+from typing import Iterable, Optional, Tuple
+
+
+class RegistryState:
+    """Registry contents built by applying big map diffs in level order, last writer wins"""
+
+    def __init__(self):
+        self.bakers = dict()
+        self.levels = dict()
+        self.level = 0
+
+    def apply(self, level: int, update: dict):
+        """Apply big map diff of a single level, stale updates (below the stored level) are ignored"""
+        for address, info in update.items():
+            if level < self.levels.get(address, -1):
+                continue
+            if info is None:
+                self.bakers.pop(address, None)
+            else:
+                self.bakers[address] = info
+            self.levels[address] = level
+        self.level = max(self.level, level)
+
+    def last_changed(self, address) -> Optional[int]:
+        """Level at which the baker entry was last written"""
+        return self.levels.get(address)
+
+    @classmethod
+    def from_updates(cls, updates: Iterable[Tuple[int, dict]]):
+        state = cls()
+        for level, update in sorted(updates, key=lambda x: x[0]):
+            state.apply(level, update)
+        return state
@@ -0,0 +1,186 @@
+import asyncio
+import gzip
+import threading
+import time
+import requests
+import simplejson as json
+from typing import Callable
+from urllib.parse import urlencode
+from pytezos.rpc.errors import RpcError
+
+from bakers_registry.metrics import get_metrics
+from bakers_registry.rpc import REQUEST_TIMEOUT
+from bakers_registry.scheduler import Scheduler, MAX_RETRIES, RETRY_STATUSES, backoff_delay, parse_retry_after
+
+LIVE, RECORD, REPLAY = 'live', 'record', 'replay'
+
+
+class Transport:
+    """
+    All indexer and node requests go through here.
+    In record mode responses are captured into a gzipped JSON cassette, in replay mode they are served from it
+    (with the original latencies multiplied by `latency_scale`) and the network is never touched.
+    """
+
+    def __init__(self, mode=LIVE, cassette=None, latency_scale=1.0):
+        assert mode in [LIVE, RECORD, REPLAY], mode
+        assert mode == LIVE or cassette, 'Cassette path is required'
+        self.mode = mode
+        self.cassette = cassette
+        self.latency_scale = latency_scale
+        self.session = requests.Session()
+        self.scheduler = Scheduler()
+        self.entries = dict()
+        self.lock = threading.Lock()
+        if mode == REPLAY:
+            with gzip.open(cassette, 'rt') as f:
+                self.entries = json.loads(f.read())
+
+    def save(self):
+        if self.mode == RECORD:
+            with gzip.open(self.cassette, 'wt') as f:
+                f.write(json.dumps(self.entries, separators=(',', ':')))
+
+    @staticmethod
+    def make_key(method, url, params=None, data=None):
+        key = f'{method} {url}'
+        if params:
+            key += '?' + urlencode(sorted(params.items()))
+        if data is not None:
+            key += ' ' + json.dumps(data, sort_keys=True, separators=(',', ':'))
+        return key
+
+    def _replay(self, key):
+        try:
+            entry = self.entries[key]
+        except KeyError:
+            raise RpcError(dict(status=None, url=key, body='Not found in the cassette'))
+        return entry['status'], entry['body'], entry['latency'] * self.latency_scale, entry.get('size', 0)
+
+    def _record(self, key, status, body, latency, size=0):
+        if self.mode == RECORD:
+            with self.lock:
+                self.entries[key] = dict(status=status, body=body, latency=latency, size=size)
+
+    def get_json(self, url, params=None):
+        """Blocking GET used by indexer adapters"""
+        key = self.make_key('GET', url, params)
+        if self.mode == REPLAY:
+            status, body, latency, size = self._replay(key)
+            time.sleep(latency)
+        else:
+            status, body, latency, size = self._get_live(url, params)
+            self._record(key, status, body, latency, size)
+
+        get_metrics().add_request(url, status, latency, size)
+
+        if status != 200:
+            raise RpcError(dict(status=status, url=url, body=body))
+        return body
+
+    def _get_live(self, url, params=None, retries=MAX_RETRIES):
+        """GET admitted by the host limiter, throttled and failed requests are retried with backoff"""
+        limiter = self.scheduler.host(url)
+        for attempt in range(retries + 1):
+            limiter.acquire()
+            started_at = time.perf_counter()
+            try:
+                response = self.session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+            except requests.RequestException:
+                limiter.release()
+                if attempt == retries:
+                    raise
+                delay = backoff_delay(attempt)
+            else:
+                latency, status, size = time.perf_counter() - started_at, response.status_code, len(response.content)
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                limiter.release(status, latency, retry_after)
+                if status not in RETRY_STATUSES or attempt == retries:
+                    return status, response.json() if status == 200 else response.text, latency, size
+                get_metrics().add_request(url, status, latency, size)
+                delay = retry_after or backoff_delay(attempt)
+
+            get_metrics().add_retry(url)
+            time.sleep(delay)
+
+    async def _request_live(self, session, method, url, data=None, retries=MAX_RETRIES):
+        """Same as _get_live, but non-blocking"""
+        limiter = self.scheduler.host(url)
+        for attempt in range(retries + 1):
+            await limiter.acquire_async()
+            started_at = time.perf_counter()
+            try:
+                async with session.request(method, url, json=data) as response:
+                    status = response.status
+                    content = await response.read()
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            except asyncio.CancelledError:
+                limiter.abandon()
+                raise
+            except Exception:
+                limiter.release()
+                if attempt == retries:
+                    raise
+                delay = backoff_delay(attempt)
+            else:
+                latency, size = time.perf_counter() - started_at, len(content)
+                limiter.release(status, latency, retry_after)
+                if status not in RETRY_STATUSES or attempt == retries:
+                    return status, json.loads(content) if status == 200 else content.decode(errors='replace'), \
+                        latency, size
+                get_metrics().add_request(url, status, latency, size)
+                delay = retry_after or backoff_delay(attempt)
+
+            get_metrics().add_retry(url)
+            await asyncio.sleep(delay)
+
+    async def request(self, session, method, url, data=None, allow_not_found=False, key_url=None,
+                      retries=MAX_RETRIES):
+        """
+        Non-blocking request made through the given aiohttp session
+        :param key_url: url to identify the response in the cassette with, if it is not the request url
+        :param retries: max number of retries on the same host
+        """
+        key = self.make_key(method, key_url or url, data=data)
+        if self.mode == REPLAY:
+            status, body, latency, size = self._replay(key)
+            await asyncio.sleep(latency)
+        else:
+            status, body, latency, size = await self._request_live(session, method, url, data, retries=retries)
+            self._record(key, status, body, latency, size)
+
+        get_metrics().add_request(url, status, latency, size)
+
+        if status == 404 and allow_not_found:
+            return None
+        if status != 200:
+            raise RpcError(dict(status=status, url=url, body=body))
+        return body
+
+    def call(self, key, fn: Callable):
+        """Record or replay the JSON-serializable result of a third-party client call"""
+        if self.mode == REPLAY:
+            _, body, latency, _ = self._replay(key)
+            time.sleep(latency)
+        else:
+            started_at = time.perf_counter()
+            body = fn()
+            latency = time.perf_counter() - started_at
+            self._record(key, 200, body, latency)
+
+        get_metrics().add_request(' '.join(key.split(' ')[:2]), 200, latency, 0)
+        return body
+
+
+transport = Transport()
+
+
+def use_transport(mode=LIVE, cassette=None, latency_scale=1.0) -> Transport:
+    """Replace the transport used by all network calls"""
+    global transport
+    transport = Transport(mode, cassette=cassette, latency_scale=latency_scale)
+    return transport
+
+
+def get_transport() -> Transport:
+    return transport
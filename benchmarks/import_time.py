@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+
+import fire
+
+# modules that only commands talking to the network or computing diffs should load
+HEAVY_MODULES = ('pytezos', 'conseil', 'aiohttp', 'requests', 'yaspin', 'sqlite3')
+COMMANDS = {
+    'import': 'import bakers_registry.cli',
+    'help': 'from bakers_registry.cli import main; sys.argv = ["bakers", "--help"]; main()',
+    'new': 'from bakers_registry.cli import main; sys.argv = ["bakers", "new"]; main()',
+}
+PROBE = '''
+import sys, time
+started_at = time.perf_counter()
+try:
+    {code}
+except SystemExit:
+    pass
+elapsed = time.perf_counter() - started_at
+sys.stderr.write("\\n%f %s\\n" % (elapsed, ",".join(m for m in {heavy!r} if m in sys.modules)))
+'''
+
+
+def probe(code) -> tuple:
+    """Run the code in a fresh interpreter, returns elapsed seconds and heavy modules it loaded"""
+    res = subprocess.run([sys.executable, '-c', PROBE.format(code=code, heavy=HEAVY_MODULES)],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
+                         env=dict(os.environ, PAGER='cat'), check=True)
+    elapsed, _, loaded = res.stderr.strip().splitlines()[-1].partition(' ')
+    return float(elapsed), [x for x in loaded.split(',') if x]
+
+
+def main(commands=tuple(COMMANDS), repeat=5, max_seconds=None):
+    """
+    Measure startup time of commands that do not need the network, fail if they load heavy modules
+    :param commands: any of import, help, new; all by default
+    :param repeat: number of runs, the fastest one is reported
+    :param max_seconds: fail if a command takes longer than that (optional)
+    """
+    if isinstance(commands, str):
+        commands = [commands]
+
+    failed = False
+    for name in commands:
+        timings = [probe(COMMANDS[name]) for _ in range(repeat)]
+        elapsed, loaded = min(timings, key=lambda x: x[0])
+        print(f'{name:>8}  {elapsed:8.3f}s  {",".join(loaded) or "-"}', file=sys.stderr)
+        if loaded or (max_seconds and elapsed > max_seconds):
+            failed = True
+
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
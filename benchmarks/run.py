@@ -0,0 +1,169 @@
+import io
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime
+from unittest import mock
+
+import fire
+import simplejson as json
+
+from bakers_registry import core
+from bakers_registry.colored import PrinterLog
+from bakers_registry.encoding import decode_snapshot, decode_record
+from benchmarks.synthetic import generate_updates, FIRST_LEVEL
+
+# total number of updates: (bakers, updates per baker)
+SCALES = {
+    1000: (100, 10),
+    10000: (500, 20),
+    100000: (1000, 100),
+}
+REGISTRY_ADDRESS = 'KT1ChNsEFxwyCbJyWGSL3KdjeXE28AY1Kaog'
+
+
+@contextmanager
+def local_registry(updates):
+    """Replace network-bound functions of the core module with in-memory stand-ins"""
+    def get_updates(registry_address, indexer, since=None, **kwargs):
+        return list(updates)
+
+    def get_snapshot(registry_address, bakers_addresses, raw=False, level=None, **kwargs):
+        return dict()
+
+    with mock.patch.object(core, 'get_updates', get_updates), \
+            mock.patch.object(core, 'get_snapshot', get_snapshot):
+        yield
+
+
+def stage_all_bakers(dataset):
+    return core.iter_all_bakers(REGISTRY_ADDRESS)
+
+
+def stage_unify_diff(dataset):
+    return core.iter_unify_diff(REGISTRY_ADDRESS, since=FIRST_LEVEL)
+
+
+def stage_decode_snapshot(dataset):
+    snapshot = {(address, level): info for level, update in dataset['updates'] for address, info in update.items()}
+    return iter(decode_snapshot(snapshot).values())
+
+
+def stage_iter_diff(dataset):
+    for before, after in dataset['pairs']:
+        yield from core.iter_diff(before, after)
+
+
+def stage_print_log(dataset):
+    PrinterLog().print_log(dataset['entries'])
+    return iter(dataset['entries'])
+
+
+STAGES = {
+    'get_all_bakers': stage_all_bakers,
+    'get_unify_diff': stage_unify_diff,
+    'decode_snapshot': stage_decode_snapshot,
+    'iter_diff': stage_iter_diff,
+    'print_log': stage_print_log,
+}
+
+
+def make_dataset(n_bakers, n_updates) -> dict:
+    updates = generate_updates(n_bakers, n_updates)
+    last, pairs = dict(), list()
+    for level, update in updates:
+        for address, info in update.items():
+            record = decode_record(info)
+            if address in last:
+                pairs.append((last[address], record))
+            last[address] = record
+
+    with redirect_stdout(io.StringIO()), local_registry(updates):
+        entries = list(core.iter_unify_diff(REGISTRY_ADDRESS, since=FIRST_LEVEL))
+
+    return dict(updates=updates, pairs=pairs, entries=entries)
+
+
+def measure(stage, dataset, trace_memory=False):
+    if trace_memory:
+        tracemalloc.start()
+    started_at = time.perf_counter()
+    first_item = None
+    items = 0
+    with redirect_stdout(io.StringIO()):
+        for _ in stage(dataset):
+            if first_item is None:
+                first_item = time.perf_counter() - started_at
+            items += 1
+    elapsed = time.perf_counter() - started_at
+    peak_memory = None
+    if trace_memory:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return items, elapsed, first_item, peak_memory
+
+
+def run_benchmarks(scales, stages, repeat):
+    results = list()
+    for scale in scales:
+        dataset = make_dataset(*SCALES[scale])
+        with local_registry(dataset['updates']):
+            for name in stages:
+                timings = [measure(STAGES[name], dataset) for _ in range(repeat)]
+                items, elapsed, first_item, _ = min(timings, key=lambda x: x[1])
+                _, _, _, peak_memory = measure(STAGES[name], dataset, trace_memory=True)
+                results.append(dict(
+                    stage=name,
+                    scale=scale,
+                    items=items,
+                    seconds=elapsed,
+                    throughput=items / elapsed if elapsed else None,
+                    first_item_latency=first_item,
+                    peak_memory=peak_memory))
+                print(f'{name:>16} {scale:>7}  {items:>8} items  {elapsed:8.3f}s  '
+                      f'{peak_memory / 2 ** 20:8.1f} MiB', file=sys.stderr)
+    return results
+
+
+def compare_results(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = {(x['stage'], x['scale']): x for x in json.loads(f.read())['results']}
+    for result in results:
+        base = baseline.get((result['stage'], result['scale']))
+        if base:
+            print(f'{result["stage"]:>16} {result["scale"]:>7}  '
+                  f'time x{result["seconds"] / base["seconds"]:.2f}  '
+                  f'memory x{result["peak_memory"] / base["peak_memory"]:.2f}', file=sys.stderr)
+
+
+def main(output_file='benchmark.json', scales=(1000, 10000, 100000), stages=tuple(STAGES), repeat=3,
+         compare=None):
+    """
+    Run core pipeline stages over synthetic registry history
+    :param output_file: path to the file to store results
+    :param scales: total number of updates, any of 1000, 10000, 100000
+    :param stages: stages to run, all by default
+    :param repeat: number of timed runs, the fastest one is reported
+    :param compare: path to results of a previous run to compare with (optional)
+    """
+    if isinstance(scales, int):
+        scales = [scales]
+    if isinstance(stages, str):
+        stages = [stages]
+
+    results = run_benchmarks(scales, stages, repeat)
+    with open(output_file, 'w+') as f:
+        f.write(json.dumps(dict(
+            timestamp=datetime.utcnow().isoformat(),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            results=results), indent=4))
+
+    if compare:
+        compare_results(results, compare)
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
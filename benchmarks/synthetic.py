@@ -0,0 +1,80 @@
+import random
+import string
+from typing import List, Tuple
+
+from bakers_registry.encoding import encode_info
+
+FIRST_LEVEL = 700000
+BASE58 = ''.join(c for c in string.ascii_letters + string.digits if c not in '0OIl')
+MUTABLE_FIELDS = ['bakerName', 'openForDelegation', 'bakerOffchainRegistryUrl', 'fee', 'bakerPaysFromAccounts',
+                  'minDelegation', 'payoutDelay', 'minPayout', 'paymentConfigMask', 'overDelegationThreshold']
+
+
+def random_address(rnd: random.Random, prefix='tz1'):
+    return prefix + ''.join(rnd.choice(BASE58) for _ in range(33))
+
+
+def random_value(rnd: random.Random, key, name):
+    if key == 'bakerName':
+        return f'{name} {rnd.choice(["Baking", "Staking", "Tezos", "Capital"])}'
+    if key == 'bakerOffchainRegistryUrl':
+        return f'https://{name.lower()}.com/registry{rnd.randrange(10)}.json'
+    if key == 'openForDelegation':
+        return rnd.random() > 0.1
+    if key == 'fee':
+        return str(rnd.choice([5, 8, 10, 12, 15, 20]) / 100)
+    if key == 'bakerPaysFromAccounts':
+        return [random_address(rnd) for _ in range(rnd.randrange(3))]
+    if key in ['minDelegation', 'minPayout']:
+        return str(rnd.choice([0, 1, 10, 100, 1000]))
+    if key == 'payoutDelay':
+        return rnd.randrange(8)
+    if key == 'paymentConfigMask':
+        return rnd.randrange(1, 16384)
+    if key == 'overDelegationThreshold':
+        return rnd.randrange(50, 101)
+    assert False, key
+
+
+def raw_info(config: dict, level):
+    info = encode_info(config)
+    info['last_update'] = 1577836800 + level * 60
+    return info
+
+
+def generate_updates(n_bakers, n_updates, seed=0) -> List[Tuple[int, dict]]:
+    """
+    Generate realistic raw big map payloads, every baker is created within the generated history
+    :param n_bakers: number of registry entries
+    :param n_updates: number of updates per baker (including creation)
+    :returns: list of (level, big map diff) sorted by level
+    """
+    rnd = random.Random(seed)
+    names, configs = dict(), dict()
+    for i in range(n_bakers):
+        address = random_address(rnd)
+        names[address] = f'Baker{i:05}'
+        configs[address] = {key: random_value(rnd, key, names[address]) for key in MUTABLE_FIELDS}
+        configs[address]['reporterAccount'] = random_address(rnd)
+
+    pending = [address for address in configs for _ in range(n_updates)]
+    rnd.shuffle(pending)
+    seen = set()
+    updates = list()
+    level = FIRST_LEVEL
+    while pending:
+        level += rnd.randrange(1, 200)
+        big_map_diff = dict()
+        for _ in range(rnd.randrange(1, 4)):
+            if not pending or pending[-1] in big_map_diff:
+                break
+            address = pending.pop()
+            config = configs[address]
+            if address in seen:
+                for key in rnd.sample(MUTABLE_FIELDS, rnd.randrange(1, 4)):
+                    config[key] = random_value(rnd, key, names[address])
+            seen.add(address)
+            big_map_diff[address] = raw_info(config, level)
+        updates.append((level, big_map_diff))
+
+    return updates
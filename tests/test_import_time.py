@@ -0,0 +1,16 @@
+import unittest
+
+from benchmarks.import_time import COMMANDS, probe
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_no_heavy_modules(self):
+        for name in ['import', 'help', 'new']:
+            with self.subTest(command=name):
+                _, loaded = probe(COMMANDS[name])
+                self.assertEqual([], loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
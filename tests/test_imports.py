@@ -0,0 +1,22 @@
+import importlib
+import pkgutil
+import unittest
+
+import bakers_registry
+
+
+class TestImports(unittest.TestCase):
+
+    def test_import_all_modules(self):
+        for module in pkgutil.iter_modules(bakers_registry.__path__):
+            with self.subTest(module=module.name):
+                importlib.import_module(f'bakers_registry.{module.name}')
+
+    def test_cli_commands(self):
+        from bakers_registry.cli import BakersRegistryCli
+        for command in ['get', 'set', 'new', 'all', 'log', 'query', 'serve']:
+            self.assertTrue(callable(getattr(BakersRegistryCli, command)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+from bakers_registry import core
+
+SNAPSHOT_DELAY = 1.0
+BLOCK_DELAY = 0.1
+
+
+class FakeEngine:
+
+    def __init__(self, network, concurrency=None):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def map(self, fn, items):
+        await asyncio.gather(*map(fn, items))
+
+    async def head_header(self):
+        return dict(level=1000)
+
+
+class TestPipelinedLog(unittest.TestCase):
+
+    def test_blocks_do_not_wait_for_snapshot(self):
+        block_started = list()
+        snapshot_done = list()
+
+        def get_big_map(registry_address, level=None):
+            time.sleep(SNAPSHOT_DELAY)
+            snapshot_done.append(time.monotonic())
+            return dict()
+
+        async def load_registry(engine, registry_address):
+            return None
+
+        async def fetch_big_map_diff(engine, baker_registry, level, registry_address=None, opg_hashes=None):
+            block_started.append(time.monotonic())
+            await asyncio.sleep(BLOCK_DELAY)
+            return level, dict()
+
+        with mock.patch.object(core, 'get_update_operations', return_value={101: None, 102: None}), \
+                mock.patch.object(core, 'get_big_map_tzkt', get_big_map), \
+                mock.patch.object(core, 'load_registry', load_registry), \
+                mock.patch.object(core, 'fetch_big_map_diff', fetch_big_map_diff), \
+                mock.patch.object(core, 'RpcEngine', FakeEngine):
+            entries = list(core.iter_unify_diff_pipelined('KT1', since=100))
+
+        self.assertEqual([], entries)
+        self.assertEqual(2, len(block_started))
+        self.assertLess(min(block_started), snapshot_done[0] - SNAPSHOT_DELAY / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()